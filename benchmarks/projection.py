@@ -0,0 +1,65 @@
+"""
+Compares the CSV readers on a wide synthetic file where only a few columns
+are used, as in an ETL job with 15 `columns` out of 300.
+
+    python benchmarks/projection.py [num_rows] [num_columns] [num_selected]
+"""
+import io
+import os
+import sys
+import csv
+import time
+import random
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from etl.etl import InsensitiveDictReader, InsensitiveCSVReader, ProjectedCSVReader
+
+
+def create_file(path, num_rows, num_columns):
+    random.seed(0)
+    with io.open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["col{num}".format(num=num) for num in range(num_columns)])
+        for row_num in range(num_rows):
+            row = [str(random.random()) for column in range(num_columns)]
+            if row_num % 100 == 0:
+                row[1] = "quoted, value"
+            writer.writerow(row)
+
+
+def bench(name, reader_factory, path, columns):
+    start = time.time()
+    with io.open(path, newline="") as f:
+        rows = 0
+        for record in reader_factory(f):
+            for column in columns:
+                record[column]
+            rows += 1
+    elapsed = time.time() - start
+    print("{name:24} {rows} rows in {elapsed:.2f}s ({rate:.0f} rows/s)".
+          format(name=name, rows=rows, elapsed=elapsed, rate=rows / elapsed))
+
+
+def main():
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    num_columns = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    num_selected = int(sys.argv[3]) if len(sys.argv) > 3 else 15
+    columns = ["col{num}".format(num=num) for num in range(0, num_columns, num_columns // num_selected)][:num_selected]
+
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    os.close(fd)
+    try:
+        create_file(path, num_rows, num_columns)
+        print("{num_rows} rows x {num_columns} columns, {num_selected} selected ({size:.1f} MB)".
+              format(num_rows=num_rows, num_columns=num_columns, num_selected=len(columns),
+                     size=os.path.getsize(path) / 1024.0 / 1024.0))
+        bench("InsensitiveDictReader", lambda f: InsensitiveDictReader(f), path, columns)
+        bench("InsensitiveCSVReader", lambda f: InsensitiveCSVReader(f, columns=columns), path, columns)
+        bench("ProjectedCSVReader", lambda f: ProjectedCSVReader(f, columns=columns), path, columns)
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+PARQUET = "parquet"
+ARROW_FILE = "arrow"
+ARROW_STREAM = "arrows"
+
+PARQUET_MAGIC = b"PAR1"
+ARROW_FILE_MAGIC = b"ARROW1"
+ARROW_STREAM_EXTENSIONS = (".arrows", ".ipc")
+
+
+def detect_format(path):
+    with open(path, "rb") as f:
+        magic = f.read(len(ARROW_FILE_MAGIC))
+    if magic.startswith(PARQUET_MAGIC):
+        return PARQUET
+    if magic.startswith(ARROW_FILE_MAGIC):
+        return ARROW_FILE
+    if path.lower().endswith(ARROW_STREAM_EXTENSIONS):
+        return ARROW_STREAM
+    return None
+
+
+class RecordBatchInput(object):
+    # Reads a Parquet, Arrow IPC file or Arrow IPC stream in record batches of
+    # at most batch_size rows, as tuples of typed Python values
+
+    def __init__(self, path, file_format, batch_size):
+        if pyarrow is None:
+            raise ValueError("Reading {file_format} files requires pyarrow".format(file_format=file_format))
+        self.path = path
+        self.file_format = file_format
+        self.batch_size = batch_size
+
+    @property
+    def num_rows(self):
+        # None for Arrow IPC streams, which do not record it
+        if self.file_format == PARQUET:
+            return pyarrow.parquet.ParquetFile(self.path).metadata.num_rows
+        if self.file_format == ARROW_FILE:
+            with pyarrow.memory_map(self.path) as source:
+                return pyarrow.ipc.open_file(source).read_all().num_rows
+        return None
+
+    def seek(self, offset):
+        # Every call to iter_batches reads the file from the beginning
+        pass
+
+    def get_schema(self):
+        if self.file_format == PARQUET:
+            return pyarrow.parquet.ParquetFile(self.path).schema_arrow
+        with pyarrow.memory_map(self.path) as source:
+            if self.file_format == ARROW_FILE:
+                return pyarrow.ipc.open_file(source).schema
+            return pyarrow.ipc.open_stream(source).schema
+
+    def resolve_columns(self, columns):
+        # Maps the requested column names to the names in the file, ignoring case
+        names = dict((name.strip().lower(), name) for name in self.get_schema().names)
+        resolved = []
+        for column in columns:
+            name = names.get(column.strip().lower())
+            if name is not None and name not in resolved:
+                resolved.append(name)
+        return resolved
+
+    def iter_batches(self, columns=None):
+        if columns:
+            columns = self.resolve_columns(columns)
+
+        for batch in self.read_batches(columns):
+            if columns:
+                batch = pyarrow.RecordBatch.from_arrays(
+                    [batch.column(batch.schema.get_field_index(name)) for name in columns], names=columns)
+            values = [column.to_pylist() for column in batch.columns]
+            yield batch.schema.names, list(zip(*values))
+
+    def read_batches(self, columns):
+        if self.file_format == PARQUET:
+            for batch in pyarrow.parquet.ParquetFile(self.path).iter_batches(batch_size=self.batch_size,
+                                                                              columns=columns or None):
+                yield batch
+            return
+
+        with pyarrow.memory_map(self.path) as source:
+            if self.file_format == ARROW_FILE:
+                reader = pyarrow.ipc.open_file(source)
+                for batch in reader.read_all().to_batches(max_chunksize=self.batch_size):
+                    yield batch
+            else:
+                for batch in pyarrow.ipc.open_stream(source):
+                    for offset in range(0, batch.num_rows, self.batch_size):
+                        yield batch.slice(offset, self.batch_size)
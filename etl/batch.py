@@ -0,0 +1,135 @@
+import time
+import logging
+from builtins import range
+
+logger = logging.getLogger('carto-etl')
+
+DONE_STATUS = "done"
+FINAL_STATUSES = ("done", "failed", "canceled", "unknown")
+
+
+class BatchDispatcher(object):
+    # Sends chunks as Batch SQL API jobs instead of synchronous requests.
+    # Chunks are grouped group_size at a time into multi-query jobs, at most
+    # max_jobs of them are kept in flight, and finished jobs are polled with an
+    # exponential backoff. Each query of a multi-query job reports its own
+    # status, so failures are mapped back to the exact chunk numbers. Every
+    # request, to create or to poll a job, waits for rate_limiter if given
+
+    def __init__(self, bsql, max_jobs, group_size, max_attempts, poll_interval, max_poll_interval,
+                 notify=None, rate_limiter=None):
+        self.bsql = bsql
+        self.max_jobs = max_jobs
+        self.group_size = group_size
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.notify = notify or (lambda message_type, message: False)
+        self.rate_limiter = rate_limiter
+        self.group = []
+        self.in_flight = {}
+        self.poll_errors = {}
+        self.failed_chunks = []
+
+    def submit(self, query, chunk_num):
+        self.group.append((chunk_num, query))
+        if len(self.group) >= self.group_size:
+            self.submit_group()
+
+    def submit_group(self):
+        if not self.group:
+            return
+        while len(self.in_flight) >= self.max_jobs:
+            self.wait()
+
+        group, self.group = self.group, []
+        chunk_nums = [chunk_num for chunk_num, query in group]
+        queries = [query for chunk_num, query in group]
+        for retry in range(self.max_attempts):
+            self.acquire()
+            try:
+                job = self.bsql.create(queries if len(queries) > 1 else queries[0])
+            except Exception as e:
+                logger.warning("Chunks {chunks}: Retrying job creation ({error_msg})".
+                               format(chunks=self.format_chunks(chunk_nums), error_msg=e))
+                self.notify('error', e)
+            else:
+                logger.info("Chunks {chunks}: Submitted as batch job {job_id}".
+                            format(chunks=self.format_chunks(chunk_nums), job_id=job['job_id']))
+                self.in_flight[job['job_id']] = chunk_nums
+                break
+        else:
+            self.fail(chunk_nums)
+
+    def wait(self):
+        # Blocks until at least one of the jobs in flight has finished
+        interval = self.poll_interval
+        while True:
+            if self.poll():
+                return
+            time.sleep(interval)
+            interval = min(interval * 2, self.max_poll_interval)
+
+    def poll(self):
+        finished = 0
+        for job_id, chunk_nums in list(self.in_flight.items()):
+            self.acquire()
+            try:
+                job = self.bsql.read(job_id)
+            except Exception as e:
+                # A job that cannot be read max_attempts times in a row, e.g.
+                # because it was deleted, is given up and its chunks failed
+                self.poll_errors[job_id] = self.poll_errors.get(job_id, 0) + 1
+                logger.warning("Batch job {job_id}: Could not check status ({error_msg})".
+                               format(job_id=job_id, error_msg=e))
+                if self.poll_errors[job_id] >= self.max_attempts:
+                    finished += 1
+                    del self.in_flight[job_id]
+                    del self.poll_errors[job_id]
+                    logger.error("Batch job {job_id}: Giving up after {attempts} failed status checks".
+                                 format(job_id=job_id, attempts=self.max_attempts))
+                    self.fail(chunk_nums)
+                continue
+            self.poll_errors.pop(job_id, None)
+            if job['status'] not in FINAL_STATUSES:
+                continue
+
+            finished += 1
+            del self.in_flight[job_id]
+            failed = [chunk_num for chunk_num, status in zip(chunk_nums, self.query_statuses(job, len(chunk_nums)))
+                      if status != DONE_STATUS]
+            for chunk_num in chunk_nums:
+                if chunk_num not in failed:
+                    logger.info("Chunk #{chunk_num}: Success!".format(chunk_num=(chunk_num + 1)))
+                    self.notify('progress', chunk_num + 1)
+            if failed:
+                logger.error("Batch job {job_id}: {status} ({reason})".
+                             format(job_id=job_id, status=job['status'], reason=job.get('failed_reason')))
+                self.fail(failed)
+        return finished
+
+    def query_statuses(self, job, num_queries):
+        # Multi-query jobs report a status per query, single ones only the job status
+        queries = job.get('query')
+        if isinstance(queries, list):
+            return [query.get('status') for query in queries]
+        return [job['status']] * num_queries
+
+    def flush(self):
+        self.submit_group()
+        while self.in_flight:
+            self.wait()
+        return self.failed_chunks
+
+    def fail(self, chunk_nums):
+        for chunk_num in chunk_nums:
+            logger.error("Chunk #{chunk_num}: Failed!)".format(chunk_num=(chunk_num + 1)))
+            self.failed_chunks.append(chunk_num + 1)
+            self.notify('error', "Failed " + str(chunk_num + 1))
+
+    def acquire(self):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+    def format_chunks(self, chunk_nums):
+        return ",".join("#" + str(chunk_num + 1) for chunk_num in chunk_nums)
@@ -0,0 +1,82 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+
+DEFAULT_MAX_MEMORY_IDS = 1000000
+
+
+class IdStore(object):
+    # Maps ids to integers (typically row numbers). Entries are kept in memory
+    # until there are more than max_memory_ids of them; then they are moved to
+    # an on-disk SQLite table and lookups check both places. Unlike the dbm
+    # fallback (dbm.dumb), SQLite does not keep an in-memory index of the keys
+
+    def __init__(self, max_memory_ids=DEFAULT_MAX_MEMORY_IDS, directory=None):
+        self.max_memory_ids = max_memory_ids
+        self.directory = directory
+        self.memory = {}
+        self.disk = None
+        self.tmp_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __setitem__(self, key, value):
+        self.memory[key] = value
+        if len(self.memory) > self.max_memory_ids:
+            self.spill()
+
+    def __len__(self):
+        if self.disk is None:
+            return len(self.memory)
+        on_disk = self.disk.execute("select count(*) from ids").fetchone()[0]
+        return on_disk + len([key for key in self.memory if self.get_from_disk(key) is None])
+
+    def get(self, key, default=None):
+        try:
+            return self.memory[key]
+        except KeyError:
+            pass
+        if self.disk is not None:
+            value = self.get_from_disk(key)
+            if value is not None:
+                return value
+        return default
+
+    def get_from_disk(self, key):
+        row = self.disk.execute("select value from ids where id = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def add(self, key):
+        self[key] = 0
+
+    def spill(self):
+        if self.disk is None:
+            self.tmp_dir = tempfile.mkdtemp(prefix="carto-etl-", dir=self.directory)
+            # The store may be closed from another thread than the one that
+            # filled it, e.g. when a generator using it is finalized
+            self.disk = sqlite3.connect(os.path.join(self.tmp_dir, "ids.sqlite"), check_same_thread=False)
+            self.disk.execute("pragma journal_mode = off")
+            self.disk.execute("pragma synchronous = off")
+            self.disk.execute("create table ids (id text primary key, value integer)")
+        self.disk.executemany("insert or replace into ids (id, value) values (?, ?)", self.memory.items())
+        self.disk.commit()
+        self.memory = {}
+
+    def close(self):
+        try:
+            if self.disk is not None:
+                self.disk.close()
+                self.disk = None
+        finally:
+            if self.tmp_dir is not None:
+                shutil.rmtree(self.tmp_dir, ignore_errors=True)
+                self.tmp_dir = None
+            self.memory = {}
@@ -1,19 +1,54 @@
+import os
+import re
 import csv
 import sys
+import time
 import logging
+import binascii
 from builtins import range
-from datetime import datetime
+from itertools import islice
+from decimal import Decimal, InvalidOperation
+from datetime import datetime, date, time as datetime_time
 
 from carto.auth import APIKeyAuthClient
 from carto.sql import SQLClient
 from carto.sql import BatchSQLClient
 
+from .batch import BatchDispatcher, FINAL_STATUSES
+from .arrow import RecordBatchInput, detect_format
+from .sinks import SQLAPISink, DirectorySink, PostgresSink, iter_sql_files
+from .pipeline import Pipeline, DEFAULT_MAX_BYTES, DEFAULT_QUEUE_SIZE
+from .reproject import Reprojector, WGS84_SRID
+from .profiling import Profiler, PSTATS_FORMAT, DEFAULT_SAMPLE_CHUNKS, DEFAULT_SAMPLE_EVERY
+from .inputs import open_input, is_compressed, DEFAULT_BUFFER_SIZE
+from .dedup import IdStore, DEFAULT_MAX_MEMORY_IDS
+from .snapshot import Snapshot, content_hash
+
 UTF8 = "utf-8"
 DEFAULT_COORD = None
 MAX_LON = 180
 MAX_LAT = 90
 NULL_VALUE = "NULL"
 CARTO_DATE_FORMAT = "%Y-%m-%d %H:%M:%S+00"
+STAGING_SUFFIX = "_etl_staging"
+STAGING_OLD_SUFFIX = "_etl_old"
+
+DELETE_IN = "in"
+DELETE_ANY = "any"
+DELETE_TEMP_TABLE = "temp_table"
+DELETE_TEMP_TABLE_NAME = "etl_delete_ids"
+ID_TYPE_BIGINT = "bigint"
+ID_TYPE_NUMERIC = "numeric"
+ID_TYPE_TEXT = "text"
+INTEGER_REGEX = re.compile(r"^[+-]?\d+$")
+COLUMN_ID_TYPES = {
+    "smallint": ID_TYPE_BIGINT,
+    "integer": ID_TYPE_BIGINT,
+    "bigint": ID_TYPE_BIGINT,
+    "numeric": ID_TYPE_NUMERIC,
+    "real": ID_TYPE_NUMERIC,
+    "double precision": ID_TYPE_NUMERIC,
+}
 
 DEFAULT_DELIMITER = ","
 DEFAULT_X_COLUMN = "lon"
@@ -29,33 +64,70 @@ DEFAULT_DATETIME_FORMAT=None
 DEFAULT_FLOAT_COMMA_SEPARATOR=None
 DEFAULT_FLOAT_THOUSAND_SEPARATOR=None
 DEFAULT_DATE_COLUMNS=None
+DEFAULT_PROJECTION=True
+DEFAULT_DEDUP=None
+DEFAULT_DEDUP_MAX_MEMORY_IDS=DEFAULT_MAX_MEMORY_IDS
+DEFAULT_SNAPSHOT_FILE=None
+DEFAULT_INPUT_BUFFER_SIZE=DEFAULT_BUFFER_SIZE
+DEFAULT_USE_MMAP=False
+DEFAULT_PIPELINE=False
+DEFAULT_PIPELINE_MAX_BYTES=DEFAULT_MAX_BYTES
+DEFAULT_PIPELINE_QUEUE_SIZE=DEFAULT_QUEUE_SIZE
+DEFAULT_SQL_OUTPUT_DIR=None
+DEFAULT_SQL_OUTPUT_COMPRESSION=None
+DEFAULT_POSTGRES_DSN=None
+DEFAULT_PROFILE_FILE=None
+DEFAULT_PROFILE_FORMAT=PSTATS_FORMAT
+DEFAULT_PROFILE_CHUNKS=DEFAULT_SAMPLE_CHUNKS
+DEFAULT_PROFILE_EVERY=DEFAULT_SAMPLE_EVERY
+DEFAULT_REPROJECT=False
+DEFAULT_REPROJECT_AREA_MARGIN=None
+DEFAULT_DELETE_STRATEGY=DELETE_IN
+DEFAULT_ID_TYPE=None
+DEFAULT_STAGING=False
+DEFAULT_OVERVIEWS=False
+DEFAULT_JOB_POLL_INTERVAL=5
+DEFAULT_BATCH_SQL=False
+DEFAULT_BATCH_MAX_JOBS=4
+DEFAULT_BATCH_GROUP_SIZE=1
+DEFAULT_BATCH_MAX_POLL_INTERVAL=60
 FORBIDDEN_FLOAT_VALUES=["INFINITY"]
 
+DEDUP_FIRST = "first"
+DEDUP_LAST = "last"
+
 logger = logging.getLogger('carto-etl')
 
 
-def chunks(full_list, chunk_size, start_chunk=1, end_chunk=None):
-    finished = False
-    while finished is False:
-        chunk = []
-        for chunk_num in range(chunk_size):
-            if chunk_num < (start_chunk - 1):
-                continue
+class InvalidIdError(ValueError):
+    pass
 
-            if end_chunk is not None and chunk_num >= end_chunk:
-                return
 
-            try:
-                chunk.append(next(full_list))
-            except StopIteration:
-                finished = True
-                if len(chunk) > 0:
-                    continue
-                else:
-                    return
-        yield chunk
+def chunks(full_list, chunk_size, start_chunk=1, end_chunk=None):
+    # Yields the chunks of full_list from start_chunk to end_chunk, both
+    # 1-based and included. The rows of the chunks before start_chunk are
+    # read and skipped
+    chunk_num = 0
+    while end_chunk is None or chunk_num < end_chunk:
+        chunk = list(islice(full_list, chunk_size))
+        if not chunk:
+            return
+        chunk_num += 1
+        if chunk_num >= start_chunk:
+            yield chunk
+
+def close_iterator(iterator):
+    close = getattr(iterator, "close", None)
+    if close is not None:
+        close()
 
 def _count(stream):
+    # Number of rows, or None for compressed files, which would have to be
+    # decompressed an extra time just to count their lines
+    if isinstance(stream, RecordBatchInput):
+        return stream.num_rows
+    if is_compressed(stream):
+        return None
     lines = 0
     for line in stream:
         lines += 1
@@ -83,6 +155,134 @@ class InsensitiveDict(dict):
         return dict.__getitem__(self, key.strip().lower())
 
 
+class InsensitiveRecord(object):
+    # A CSV row backed by its list of values. Column positions come from an
+    # index shared by all the rows of a file, which holds the normalized header
+    # names and also the configured column names as given, so that the usual
+    # lookups do not need to strip() and lower() the key
+
+    __slots__ = ("values", "index")
+
+    def __init__(self, values, index):
+        self.values = values
+        self.index = index
+
+    def __getitem__(self, key):
+        try:
+            position = self.index[key]
+        except KeyError:
+            position = self.index[key.strip().lower()]
+        try:
+            return self.values[position]
+        except IndexError:
+            return None
+
+    def __contains__(self, key):
+        return key in self.index or key.strip().lower() in self.index
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+class TypedRecord(InsensitiveRecord):
+    # A row read from a Parquet or Arrow file, whose values are typed Python
+    # objects instead of strings
+
+    __slots__ = ()
+
+
+class InsensitiveCSVReader(object):
+    # Faster replacement for InsensitiveDictReader: the header is normalized
+    # once and rows are plain lists wrapped in InsensitiveRecord
+
+    def __init__(self, f, delimiter=DEFAULT_DELIMITER, columns=()):
+        self.reader = csv.reader(f, delimiter=delimiter)
+        self.fieldnames = [field.strip().lower() for field in next(self.reader, [])]
+        self.index = dict((field, position) for position, field in enumerate(self.fieldnames))
+        for column in columns:
+            normalized_column = column.strip().lower()
+            if normalized_column in self.index:
+                self.index[column] = self.index[normalized_column]
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        values = next(self.reader)
+        while not values:
+            values = next(self.reader)
+        return InsensitiveRecord(values, self.index)
+
+    next = __next__
+
+
+class ProjectedCSVReader(object):
+    # Reads only the given columns. Their positions are resolved from the
+    # header once, and each row keeps just their values. Lines without quotes
+    # are split directly, and only up to the last needed column; quoted ones,
+    # which may span several lines, go through the csv module
+
+    def __init__(self, f, delimiter=DEFAULT_DELIMITER, columns=(), quotechar='"'):
+        self.lines = iter(f)
+        self.delimiter = delimiter
+        self.quotechar = quotechar
+        self.pending = None
+        self.reader = csv.reader(self.feed(), delimiter=delimiter, quotechar=quotechar)
+
+        header = next(self.lines, None)
+        self.fieldnames = [field.strip().lower() for field in self.parse(header)] if header is not None else []
+        header_index = dict((field, position) for position, field in enumerate(self.fieldnames))
+
+        self.positions = []
+        self.index = {}
+        for column in columns:
+            normalized_column = column.strip().lower()
+            position = header_index.get(normalized_column)
+            if position is None:
+                continue
+            if position not in self.positions:
+                self.positions.append(position)
+            self.index[column] = self.index[normalized_column] = self.positions.index(position)
+        self.max_split = max(self.positions) + 1 if self.positions else 0
+
+    def feed(self):
+        # Yields the line being parsed and, if a quoted field spans several
+        # lines, the following ones
+        while True:
+            line = self.pending
+            self.pending = None
+            if line is None:
+                line = next(self.lines, None)
+                if line is None:
+                    return
+            yield line
+
+    def parse(self, line):
+        self.pending = line
+        return next(self.reader)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = next(self.lines)
+        while not line.strip("\r\n"):
+            line = next(self.lines)
+
+        if self.quotechar in line:
+            fields = self.parse(line)
+        else:
+            fields = line.rstrip("\r\n").split(self.delimiter, self.max_split)
+        num_fields = len(fields)
+        return InsensitiveRecord([fields[position] if position < num_fields else None
+                                  for position in self.positions], self.index)
+
+    next = __next__
+
+
 class UploadJob(object):
     def __init__(self, csv_file_path, **kwargs):
         self.__set_max_csv_length()
@@ -102,11 +302,17 @@ class UploadJob(object):
 
         self.csv_file_path = csv_file_path
 
-        if self.api_key:
+        if self.api_key and getattr(self, "sql", None) is None:
             self.api_auth = APIKeyAuthClient(self.base_url, self.api_key)
             self.sql = SQLClient(self.api_auth)
             self.bsql = BatchSQLClient(self.api_auth)
 
+        if self.sink is None:
+            if self.sql_output_dir:
+                self.sink = DirectorySink(self.sql_output_dir, self.sql_output_compression)
+            elif self.postgres_dsn:
+                self.sink = PostgresSink(self.postgres_dsn)
+
     def __set_defaults(self):
         self.delimiter = DEFAULT_DELIMITER
         self.x_column = DEFAULT_X_COLUMN
@@ -122,6 +328,42 @@ class UploadJob(object):
         self.float_comma_separator = DEFAULT_FLOAT_COMMA_SEPARATOR
         self.float_thousand_separator = DEFAULT_FLOAT_THOUSAND_SEPARATOR
         self.date_columns = DEFAULT_DATE_COLUMNS
+        self.input_buffer_size = DEFAULT_INPUT_BUFFER_SIZE
+        self.use_mmap = DEFAULT_USE_MMAP
+        self.projection = DEFAULT_PROJECTION
+        self.dedup = DEFAULT_DEDUP
+        self.dedup_max_memory_ids = DEFAULT_DEDUP_MAX_MEMORY_IDS
+        self.skipped_rows = 0
+        self.failed_chunks = []
+        self.processed_rows = 0
+        self.rate_limiter = None
+        self.pipeline = DEFAULT_PIPELINE
+        self.pipeline_max_bytes = DEFAULT_PIPELINE_MAX_BYTES
+        self.pipeline_queue_size = DEFAULT_PIPELINE_QUEUE_SIZE
+        self.pipeline_stats = []
+        self.profile_file = DEFAULT_PROFILE_FILE
+        self.profile_format = DEFAULT_PROFILE_FORMAT
+        self.profile_chunks = DEFAULT_PROFILE_CHUNKS
+        self.profile_every = DEFAULT_PROFILE_EVERY
+        self.profiler = None
+        self.reproject = DEFAULT_REPROJECT
+        self.reproject_area_margin = DEFAULT_REPROJECT_AREA_MARGIN
+        self.reprojector = None
+        self.delete_strategy = DEFAULT_DELETE_STRATEGY
+        self.id_type = DEFAULT_ID_TYPE
+        self.staging = DEFAULT_STAGING
+        self.insert_table_name = None
+        self.overviews = DEFAULT_OVERVIEWS
+        self.job_poll_interval = DEFAULT_JOB_POLL_INTERVAL
+        self.batch_sql = DEFAULT_BATCH_SQL
+        self.batch_max_jobs = DEFAULT_BATCH_MAX_JOBS
+        self.batch_group_size = DEFAULT_BATCH_GROUP_SIZE
+        self.batch_max_poll_interval = DEFAULT_BATCH_MAX_POLL_INTERVAL
+        self.dispatcher = None
+        self.sink = None
+        self.sql_output_dir = DEFAULT_SQL_OUTPUT_DIR
+        self.sql_output_compression = DEFAULT_SQL_OUTPUT_COMPRESSION
+        self.postgres_dsn = DEFAULT_POSTGRES_DSN
         self.observer = None
 
     def __set_max_csv_length(self):
@@ -146,16 +388,141 @@ class UploadJob(object):
             self.date_columns = self.date_columns.replace(' ', '')
 
     def run(self, start_chunk=1, end_chunk=None):
-        if not isinstance(self.csv_file_path, str):
+        if not self.profile_file:
+            return self.do_open(start_chunk, end_chunk)
+
+        self.profiler = Profiler(self.profile_file, self.profile_format, self.profile_chunks, self.profile_every)
+        self.profiler.start()
+        try:
+            self.do_open(start_chunk, end_chunk)
+        finally:
+            self.profiler.stop()
+            self.profiler.write()
+            logger.info(self.profiler.summary())
+
+    def do_open(self, start_chunk, end_chunk):
+        self.open_sink(resume=start_chunk != 1)
+        try:
+            self.do_read(start_chunk, end_chunk)
+            self.flush()
+        finally:
+            self.close_sink()
+
+    def do_read(self, start_chunk, end_chunk):
+        file_format = None
+        if isinstance(self.csv_file_path, str):
+            file_format = detect_format(self.csv_file_path)
+
+        if file_format is not None:
+            self.do_run(RecordBatchInput(self.csv_file_path, file_format, self.chunk_size), start_chunk, end_chunk)
+        elif not isinstance(self.csv_file_path, str):
             self.do_run(self.csv_file_path, start_chunk, end_chunk)
         else:
             if sys.version_info <= (3, 0):
                 with open(self.csv_file_path) as f:
                     self.do_run(f, start_chunk, end_chunk)
             else:
-                with open(self.csv_file_path, encoding=self.file_encoding) as f:
+                with open_input(self.csv_file_path, self.file_encoding,
+                                self.input_buffer_size, self.use_mmap) as f:
                     self.do_run(f, start_chunk, end_chunk)
 
+    def flush(self):
+        # Waits for the chunks submitted as batch jobs, if any. The dispatcher
+        # is discarded, so that a later run does not report them again
+        if self.dispatcher is not None:
+            self.dispatcher.flush()
+            self.failed_chunks.extend(chunk_num for chunk_num in self.dispatcher.failed_chunks
+                                      if chunk_num not in self.failed_chunks)
+            self.dispatcher = None
+
+    def get_csv_reader(self, stream):
+        if isinstance(stream, RecordBatchInput):
+            return self.read_record_batches(stream)
+        if self.projection:
+            return ProjectedCSVReader(stream, delimiter=self.delimiter, columns=self.get_used_columns())
+        return InsensitiveCSVReader(stream, delimiter=self.delimiter, columns=self.get_used_columns())
+
+    def read_record_batches(self, source):
+        columns = self.get_used_columns() if self.projection else None
+        for fieldnames, rows in source.iter_batches(columns):
+            index = dict((field.strip().lower(), position) for position, field in enumerate(fieldnames))
+            for column in columns or ():
+                normalized_column = column.strip().lower()
+                if normalized_column in index:
+                    index[column] = index[normalized_column]
+            for values in rows:
+                yield TypedRecord(values, index)
+
+    def get_used_columns(self):
+        columns = self.columns.split(",") if self.columns else []
+        for column in (self.x_column, self.y_column, self.force_the_geom, getattr(self, "id_column", None)):
+            if column and column not in columns:
+                columns.append(column)
+        return columns
+
+    def read_records(self, stream):
+        csv_reader = self.get_csv_reader(stream)
+        if not self.dedup:
+            return self.count_records(csv_reader)
+        if self.dedup not in (DEDUP_FIRST, DEDUP_LAST):
+            raise ValueError("dedup must be '{first}' or '{last}'".format(first=DEDUP_FIRST, last=DEDUP_LAST))
+        if getattr(self, "id_column", None) is None:
+            raise ValueError("dedup requires an id_column")
+        return self.count_records(self.deduplicate(csv_reader, stream))
+
+    def count_records(self, records):
+        self.processed_rows = 0
+        try:
+            for record in records:
+                self.processed_rows += 1
+                yield record
+        finally:
+            close_iterator(records)
+
+    def deduplicate(self, csv_reader, stream):
+        # Skips records whose id_column value was already seen. With the "last"
+        # policy the file is read twice: first to find the last row of each id,
+        # then to emit only those rows
+        self.skipped_rows = 0
+        with IdStore(self.dedup_max_memory_ids) as seen:
+            if self.dedup == DEDUP_LAST:
+                for row_num, record in enumerate(csv_reader):
+                    id_value = self.get_id_value(record)
+                    if id_value is not None:
+                        seen[id_value] = row_num
+                stream.seek(0)
+                csv_reader = self.get_csv_reader(stream)
+
+            for row_num, record in enumerate(csv_reader):
+                id_value = self.get_id_value(record)
+                if id_value is None:
+                    yield record
+                elif self.dedup == DEDUP_LAST:
+                    if seen.get(id_value) == row_num:
+                        yield record
+                    else:
+                        self.skipped_rows += 1
+                elif id_value in seen:
+                    self.skipped_rows += 1
+                else:
+                    seen.add(id_value)
+                    yield record
+
+        logger.info("Skipped {skipped_rows} duplicated rows".format(skipped_rows=self.skipped_rows))
+        self.notify('skipped_rows', self.skipped_rows)
+
+    def get_id_value(self, record):
+        try:
+            value = record[self.id_column]
+        except KeyError:
+            return None
+        if isinstance(record, TypedRecord) and value is not None:
+            return str(value)
+        try:
+            return value.strip()
+        except AttributeError:
+            return None
+
     def notify(self, message_type, message):
         observer = getattr(self, "observer", None)
         if callable(observer):
@@ -163,16 +530,130 @@ class UploadJob(object):
             return True
         return False
 
+    def notify_total_rows(self, stream, rows_per_item=1):
+        # Sends the number of rows, or of chunks, to the observer, unless the
+        # input is compressed
+        total_rows = _count(stream)
+        if total_rows is not None:
+            self.notify('total_rows', total_rows / rows_per_item)
+
+    def acquire_rate_limit(self):
+        # Waits for the rate limit shared with the other jobs of the account,
+        # before every request to CARTO
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+    def create_batch_job(self, query):
+        self.acquire_rate_limit()
+        return self.bsql.create(query)
+
     def regenerate_overviews(self):
         query = 'select CDB_CreateOverviews(\'{table}\'::regclass)'.\
             format(table=self.table_name)
-        job_result = self.bsql.create(query)
+        job_result = self.create_batch_job(query)
         return job_result['job_id']
 
     def check_job(self, job_id):
+        self.acquire_rate_limit()
         return self.bsql.read(job_id)
 
-    def create_geom_query(self, record):
+    def wait_for_job(self, job_id):
+        while True:
+            job = self.check_job(job_id)
+            if job['status'] in FINAL_STATUSES:
+                return job
+            time.sleep(self.job_poll_interval)
+
+    def get_staging_table_name(self):
+        return self.table_name + STAGING_SUFFIX
+
+    def create_staging_table(self):
+        # The staging table copies the columns, defaults and CHECK constraints
+        # of the live table, but not its indexes, which are built after the
+        # load. It gets its own cartodb_id sequence: the default copied from
+        # the live table uses the live table's sequence, which would then
+        # depend on both tables and could not be dropped
+        query = "drop table if exists {staging}; " \
+                "create unlogged table {staging} (like {table} including all excluding indexes); " \
+                "create sequence {staging}_cartodb_id_seq owned by {staging}.cartodb_id; " \
+                "alter table {staging} alter column cartodb_id set default nextval('{staging}_cartodb_id_seq')".\
+            format(table=self.table_name, staging=self.get_staging_table_name())
+        self.send_sql(query, self.file_encoding, -1)
+
+    def swap_staging_table(self):
+        # Replaces the live table with the staging one in a single transaction:
+        # the live table is renamed out of the way and dropped, the staging
+        # table is renamed in and cartodbfied, which builds its primary key and
+        # geometry indexes, and the remaining indexes, foreign keys, triggers
+        # and grants of the live table are recreated on it. CHECK constraints
+        # come with the staging table. Views on the live table, or foreign keys
+        # of other tables referencing it, make the drop, and so the whole swap,
+        # fail. Runs as a batch job since it can take long
+        query = """
+            begin;
+            create temp table etl_indexes on commit drop as
+                select indexdef from pg_indexes
+                where schemaname = current_schema() and tablename = '{table}';
+            create temp table etl_foreign_keys on commit drop as
+                select conname, pg_get_constraintdef(oid) as condef from pg_constraint
+                where conrelid = '{table}'::regclass and contype = 'f';
+            create temp table etl_triggers on commit drop as
+                select tgname, pg_get_triggerdef(oid) as tgdef from pg_trigger
+                where tgrelid = '{table}'::regclass and not tgisinternal;
+            create temp table etl_grants on commit drop as
+                select grantee, privilege_type from information_schema.role_table_grants
+                where table_schema = current_schema() and table_name = '{table}' and grantee <> current_user;
+            {drop_overviews}
+            alter table {table} rename to {old};
+            alter table {staging} set logged;
+            alter table {staging} rename to {table};
+            drop table {old};
+            drop sequence if exists {table}_cartodb_id_seq;
+            alter sequence {staging}_cartodb_id_seq rename to {table}_cartodb_id_seq;
+            select CDB_CartodbfyTable(current_schema(), '{table}'::regclass);
+            do $$
+            declare idx record;
+            declare foreign_key record;
+            declare trigger_row record;
+            declare grant_row record;
+            begin
+                for idx in select indexdef from etl_indexes loop
+                    execute regexp_replace(idx.indexdef, 'INDEX ', 'INDEX IF NOT EXISTS ');
+                end loop;
+                for foreign_key in select conname, condef from etl_foreign_keys loop
+                    execute format('alter table %I add constraint %I %s', '{table}', foreign_key.conname,
+                                   foreign_key.condef);
+                end loop;
+                -- Triggers that CDB_CartodbfyTable already created are kept
+                for trigger_row in select tgname, tgdef from etl_triggers
+                        where tgname not in (select tgname from pg_trigger where tgrelid = '{table}'::regclass) loop
+                    execute trigger_row.tgdef;
+                end loop;
+                for grant_row in select grantee, privilege_type from etl_grants loop
+                    execute format('grant %s on table %I to %s', grant_row.privilege_type, '{table}',
+                                   case when grant_row.grantee = 'PUBLIC' then 'public'
+                                        else quote_ident(grant_row.grantee) end);
+                end loop;
+            end $$;
+            commit;
+        """.format(table=self.table_name, staging=self.get_staging_table_name(),
+                   old=self.table_name + STAGING_OLD_SUFFIX,
+                   drop_overviews="select CDB_DropOverviews('{table}'::regclass);".
+                   format(table=self.table_name) if self.overviews else "")
+        job = self.wait_for_job(self.create_batch_job(query)['job_id'])
+        if job['status'] != 'done':
+            logger.error("Swapping {staging} into {table} failed: {status}".
+                         format(staging=self.get_staging_table_name(), table=self.table_name, status=job['status']))
+            self.notify('error', "Failed staging swap")
+            return False
+
+        logger.info("Swapped {staging} into {table}".
+                    format(staging=self.get_staging_table_name(), table=self.table_name))
+        if self.overviews:
+            self.regenerate_overviews()
+        return True
+
+    def create_geom_query(self, record, point=None):
         null_result = NULL_VALUE + ","
         if self.force_the_geom:
             return self.parse_column_value(record, self.force_the_geom, parse_float=False)
@@ -180,6 +661,14 @@ class UploadJob(object):
         if self.force_no_geometry:
             return null_result
 
+        if self.needs_reprojection():
+            if point is None:
+                point = self.reproject_records([record])[0]
+            if point is None:
+                return null_result
+            return "st_setsrid(st_makepoint({longitude}, {latitude}), 4326),".\
+                format(longitude=repr(point[0]), latitude=repr(point[1]))
+
         longitude = self.get_longitude(record)
         latitude = self.get_latitude(record)
 
@@ -191,9 +680,28 @@ class UploadJob(object):
             "{longitude}, {latitude}), {srid}), 4326),".\
             format(longitude=longitude, latitude=latitude, srid=self.srid)
 
+    def needs_reprojection(self):
+        return self.reproject and int(self.srid) != WGS84_SRID and \
+            not self.force_the_geom and not self.force_no_geometry
+
+    def reproject_records(self, records):
+        # Points in EPSG:4326 for a chunk of records, transformed in a single
+        # batch on the client instead of with st_transform on the server
+        if self.reprojector is None:
+            self.reprojector = Reprojector(self.srid, self.reproject_area_margin)
+        xs = [self.get_coord(record, self.x_column) for record in records]
+        ys = [self.get_coord(record, self.y_column) for record in records]
+        return self.reprojector.transform(xs, ys)
+
     def parse_column_value(self, record, column, parse_float=True):
         null_result = NULL_VALUE + ","
 
+        if isinstance(record, TypedRecord):
+            try:
+                return self.format_typed_value(record[column]) + ","
+            except KeyError:
+                return null_result
+
         try:
             value = self.escape_value(record[column])
         except Exception:
@@ -216,6 +724,28 @@ class UploadJob(object):
                 result = "'{value}',".format(value=value)
         return result
 
+    def format_typed_value(self, value):
+        # SQL literal for a typed value read from a Parquet or Arrow file
+        if value is None:
+            return NULL_VALUE
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        if isinstance(value, (int, float)):
+            if value != value or value in (float("inf"), float("-inf")):
+                return NULL_VALUE
+            return repr(value)
+        if isinstance(value, Decimal):
+            return str(value)
+        if isinstance(value, datetime):
+            if value.tzinfo is None:
+                return "'{value}+00'".format(value=value.isoformat(" "))
+            return "'{value}'".format(value=value.isoformat(" "))
+        if isinstance(value, (date, datetime_time)):
+            return "'{value}'".format(value=value.isoformat())
+        if isinstance(value, bytes):
+            return "'\\x{value}'::bytea".format(value=binascii.hexlify(value).decode("ascii"))
+        return "'{value}'".format(value=self.escape_value(str(value)))
+
     def is_date_column(self, column):
         return column is not None and self.date_columns is not None and column in self.date_columns.split(',')
 
@@ -236,7 +766,7 @@ class UploadJob(object):
     def get_longitude(self, record):
         try:
             longitude = self.get_coord(record, self.x_column)
-            if abs(longitude) > MAX_LON:
+            if int(self.srid) == WGS84_SRID and abs(longitude) > MAX_LON:
                 return None
         except TypeError:
             return DEFAULT_COORD
@@ -246,7 +776,7 @@ class UploadJob(object):
     def get_latitude(self, record):
         try:
             latitude = self.get_coord(record, self.y_column)
-            if abs(latitude) > MAX_LAT:
+            if int(self.srid) == WGS84_SRID and abs(latitude) > MAX_LAT:
                 return None
         except TypeError:
             return DEFAULT_COORD
@@ -254,6 +784,11 @@ class UploadJob(object):
             return latitude
 
     def get_coord(self, record, type):
+        if isinstance(record, TypedRecord):
+            try:
+                return float(record[type]) or DEFAULT_COORD
+            except (ValueError, TypeError, KeyError):
+                return DEFAULT_COORD
         try:
             coord = self.parse_float_value(record[type]) or DEFAULT_COORD
         except (ValueError, KeyError):
@@ -270,14 +805,279 @@ class UploadJob(object):
             value = value.replace(self.float_comma_separator, ".")
         return float(value)
 
+    def parse_decimal_value(self, value):
+        # Like parse_float_value, but keeps every digit of the value
+        if self.float_thousand_separator:
+            value = value.replace(self.float_thousand_separator, "")
+        if self.float_comma_separator:
+            value = value.replace(self.float_comma_separator, ".")
+        try:
+            decimal_value = Decimal(value.strip())
+        except InvalidOperation:
+            raise ValueError(value)
+        if not decimal_value.is_finite():
+            raise ValueError(value)
+        return decimal_value
+
+    def send_chunks(self, stream, start_chunk, end_chunk):
+        chunk_iterator = self.iter_chunks(stream, start_chunk, end_chunk)
+        if self.profiler is not None:
+            if self.pipeline:
+                logger.warning("Profiling runs the stages sequentially, ignoring pipeline")
+            return self.send_profiled_chunks(chunk_iterator)
+
+        if not self.pipeline:
+            for chunk_num, record_chunk in chunk_iterator:
+                self.send(self.build_query(record_chunk), self.file_encoding, chunk_num)
+            return
+
+        pipeline = Pipeline(self.pipeline_max_bytes, self.pipeline_queue_size)
+        try:
+            pipeline.run(chunk_iterator, self.build_query,
+                         lambda query, chunk_num: self.send(query, self.file_encoding, chunk_num),
+                         chunk_size=self.estimate_chunk_size, query_size=lambda query: len(query or ""))
+        finally:
+            self.pipeline_stats = [stats.as_dict() for stats in pipeline.stats]
+            self.notify('pipeline_stats', "; ".join(str(stats) for stats in pipeline.stats))
+
+    def send_profiled_chunks(self, chunk_iterator):
+        chunk_iterator = iter(chunk_iterator)
+        while True:
+            sampled = self.profiler.next_chunk()
+            with self.profiler.stage("parse", sampled):
+                item = next(chunk_iterator, None)
+            if item is None:
+                self.profiler.discard_chunk(sampled, "parse")
+                break
+            chunk_num, record_chunk = item
+            with self.profiler.stage("serialize", sampled):
+                query = self.build_query(record_chunk)
+            with self.profiler.stage("send", sampled):
+                self.send(query, self.file_encoding, chunk_num)
+
+    def iter_chunks(self, stream, start_chunk, end_chunk):
+        # Closing this generator closes the reader, e.g. the deduplication
+        # store, in the calling thread
+        csv_reader = self.read_records(stream)
+        try:
+            for item in enumerate(chunks(csv_reader, self.chunk_size, start_chunk, end_chunk), start_chunk - 1):
+                yield item
+        finally:
+            close_iterator(csv_reader)
+
+    def build_query(self, record_chunk):
+        raise NotImplementedError
+
+    def estimate_chunk_size(self, record_chunk):
+        # Memory held by a chunk as measured by sys.getsizeof: the list of
+        # records, each record with its list of values, and every value
+        # including its object header, not just its characters
+        size = sys.getsizeof(record_chunk)
+        for record in record_chunk:
+            values = getattr(record, "values", ())
+            size += sys.getsizeof(record) + sys.getsizeof(values)
+            for value in values:
+                size += sys.getsizeof(value)
+        return size
+
+    def build_insert_query(self, records, table_name=None):
+        query = "insert into {table_name} (the_geom,{columns}) values".\
+            format(table_name=table_name or self.table_name, columns=self.columns.lower())
+        points = self.reproject_records(records) if self.needs_reprojection() else [None] * len(records)
+        for record, point in zip(records, points):
+            query += " (" + self.create_geom_query(record, point)
+            for column in self.columns.split(","):
+                query += self.parse_column_value(record, column)
+            query = query[:-1] + "),"
+
+        return query[:-1]
+
+    def build_update_query(self, record):
+        query = "update {table_name} set ".\
+                format(table_name=self.table_name)
+        query += " the_geom = " + self.create_geom_query(record)
+        for column in self.columns.split(","):
+            if column == self.id_column:
+                continue
+
+            value = self.parse_column_value(record, column)
+            query += "{column} = ".format(column=column) + value
+        if isinstance(record, TypedRecord):
+            return query[:-1] + " where {id_column} = {id}".\
+                format(id_column=self.id_column, id=self.format_typed_value(record[self.id_column]))
+        try:
+            id_value = record[self.id_column]
+            self.parse_float_value(id_value)
+        except ValueError:
+            query = query[:-1] + " where {id_column} = '{id}'".\
+                format(id_column=self.id_column, id=id_value)
+        else:
+            query = query[:-1] + " where {id_column} = {id}".\
+                format(id_column=self.id_column, id=id_value)
+
+        return query
+
+    def build_delete_query(self, records):
+        if self.delete_strategy == DELETE_ANY:
+            return self.build_delete_any_query(records)
+        if self.delete_strategy == DELETE_TEMP_TABLE:
+            return self.build_delete_temp_table_query(records)
+        if self.delete_strategy != DELETE_IN:
+            raise ValueError("Unknown delete_strategy: {strategy}".format(strategy=self.delete_strategy))
+
+        query = "delete from {table_name} where {column} in (".\
+            format(table_name=self.table_name, column=self.id_column.lower())
+        for record in records:
+            query += self.parse_column_value(record, self.id_column)
+
+        return query[:-1] + ")"
+
+    def build_delete_any_query(self, records):
+        return "delete from {table_name} where {column} = ANY(ARRAY[{ids}]::{id_type}[])".\
+            format(table_name=self.table_name, column=self.id_column.lower(),
+                   ids=",".join(self.get_id_literals(records)), id_type=self.get_id_type(records))
+
+    def build_delete_temp_table_query(self, records):
+        return "begin; " \
+               "create temp table {temp_table} (id {id_type}) on commit drop; " \
+               "insert into {temp_table} (id) values ({ids}); " \
+               "delete from {table_name} using {temp_table} where {table_name}.{column} = {temp_table}.id; " \
+               "commit;".\
+            format(table_name=self.table_name, column=self.id_column.lower(), temp_table=DELETE_TEMP_TABLE_NAME,
+                   ids="),(".join(self.get_id_literals(records)), id_type=self.get_id_type(records))
+
+    def get_id_type(self, records):
+        # Read once per job from the type of id_column in the table, or, when
+        # the queries do not go to CARTO, detected from the first id, unless
+        # id_type is set
+        if self.id_type is None:
+            self.id_type = self.read_id_type()
+        if self.id_type is None:
+            for record in records:
+                id_value = self.get_id_value(record)
+                if not id_value:
+                    continue
+                if isinstance(record, TypedRecord):
+                    value = record[self.id_column]
+                    self.id_type = ID_TYPE_BIGINT if isinstance(value, int) else \
+                        ID_TYPE_NUMERIC if isinstance(value, (float, Decimal)) else ID_TYPE_TEXT
+                elif INTEGER_REGEX.match(id_value):
+                    self.id_type = ID_TYPE_BIGINT
+                else:
+                    try:
+                        self.parse_float_value(id_value)
+                        self.id_type = ID_TYPE_NUMERIC
+                    except ValueError:
+                        self.id_type = ID_TYPE_TEXT
+                logger.info("Using {id_type} ids".format(id_type=self.id_type))
+                break
+        return self.id_type or ID_TYPE_TEXT
+
+    def read_id_type(self):
+        # Type of id_column in the table; types other than numbers, e.g. uuid,
+        # are used as they are for the array and temp table
+        if self.sink is not None or getattr(self, "sql", None) is None:
+            return None
+        query = "select format_type(atttypid, atttypmod) as id_type from pg_attribute " \
+                "where attrelid = '{table_name}'::regclass and attname = '{column}'".\
+            format(table_name=self.table_name, column=self.escape_value(self.id_column.lower()))
+        self.acquire_rate_limit()
+        try:
+            rows = self.sql.send(query)['rows']
+        except Exception as e:
+            logger.warning("Could not read the type of {column} ({error_msg})".
+                           format(column=self.id_column, error_msg=e))
+            return None
+        if not rows:
+            return None
+        column_type = rows[0]['id_type']
+        id_type = COLUMN_ID_TYPES.get(column_type, column_type)
+        logger.info("Using {id_type} ids, from {column_type} column {column}".
+                    format(id_type=id_type, column_type=column_type, column=self.id_column))
+        return id_type
+
+    def get_id_literals(self, records):
+        # Raises InvalidIdError if an id is not of the id type, so that its
+        # chunk fails instead of silently leaving the row behind
+        id_type = self.get_id_type(records)
+        literals = []
+        for record in records:
+            id_value = self.get_id_value(record)
+            if not id_value:
+                continue
+            try:
+                if id_type == ID_TYPE_BIGINT:
+                    literals.append(str(int(id_value)))
+                elif id_type == ID_TYPE_NUMERIC:
+                    literals.append(str(self.parse_decimal_value(id_value)))
+                else:
+                    literals.append("'{value}'".format(value=self.escape_value(id_value)))
+            except ValueError:
+                raise InvalidIdError("Id {id} is not {id_type}".format(id=id_value, id_type=id_type))
+        return literals or [NULL_VALUE]
+
+    def build_delete_chunk_query(self, records):
+        # None if the chunk has invalid ids, which makes send() fail it
+        try:
+            return self.build_delete_query(records)
+        except InvalidIdError as e:
+            logger.error(str(e))
+            return None
+
     def send(self, query, file_encoding, chunk_num):
+        if query is None:
+            logger.error("Chunk #{chunk_num}: Failed!)".
+                         format(chunk_num=(chunk_num + 1)))
+            self.failed_chunks.append(chunk_num + 1)
+            self.notify('error', "Failed " + str(chunk_num + 1))
+        elif self.batch_sql and self.sink is None:
+            self.get_dispatcher().submit(query, chunk_num)
+        else:
+            self.send_sql(query, file_encoding, chunk_num)
+
+    def get_dispatcher(self):
+        if self.dispatcher is None:
+            self.dispatcher = BatchDispatcher(self.bsql, self.batch_max_jobs, self.batch_group_size,
+                                              self.max_attempts, self.job_poll_interval,
+                                              self.batch_max_poll_interval, self.notify, self.rate_limiter)
+        return self.dispatcher
+
+    def get_sink(self):
+        if self.sink is None:
+            return SQLAPISink(self.sql)
+        return self.sink
+
+    def replay(self, directory, chunk_nums=None):
+        # Sends the queries written by a DirectorySink, e.g. those of
+        # failed_chunks, with the job's own sink or the SQL API
+        if isinstance(self.sink, DirectorySink) and \
+                os.path.abspath(self.sink.directory) == os.path.abspath(directory):
+            raise ValueError("Cannot replay {directory} into itself".format(directory=directory))
+        self.open_sink(resume=chunk_nums is not None)
+        try:
+            for chunk_num, query in iter_sql_files(directory, chunk_nums):
+                self.send(query, self.file_encoding, chunk_num - 1)
+            self.flush()
+        finally:
+            self.close_sink()
+
+    def open_sink(self, resume=False):
+        if self.sink is not None:
+            self.sink.open(resume)
+
+    def close_sink(self):
+        if self.sink is not None:
+            self.sink.close()
+
+    def send_sql(self, query, file_encoding, chunk_num):
         if sys.version_info <= (3, 0):
             query = query.decode(file_encoding).encode(UTF8)
         logger.debug("Chunk #{chunk_num}: {query}".
                     format(chunk_num=(chunk_num + 1), query=query))
         for retry in range(self.max_attempts):
+            self.acquire_rate_limit()
             try:
-                self.sql.send(query)
+                self.get_sink().send(query, chunk_num)
             except Exception as e:
                 logger.warning("Chunk #{chunk_num}: Retrying ({error_msg})".
                                format(chunk_num=(chunk_num + 1), error_msg=e))
@@ -290,26 +1090,43 @@ class UploadJob(object):
         else:
             logger.error("Chunk #{chunk_num}: Failed!)".
                          format(chunk_num=(chunk_num + 1)))
+            self.failed_chunks.append(chunk_num + 1)
             self.notify('error', "Failed " + str(chunk_num + 1))
 
 
 class InsertJob(UploadJob):
+    # With staging=true rows are loaded into an unlogged copy of the table
+    # without indexes, which is swapped in once every chunk has been sent.
+    # The staging table is recreated on every run, so the whole file is
+    # always loaded
+
     def do_run(self, stream, start_chunk, end_chunk):
-        self.notify('total_rows', _count(stream) / int(self.chunk_size))
-        csv_reader = InsensitiveDictReader(stream, delimiter=self.delimiter)
-        for chunk_num, record_chunk in enumerate(
-                    chunks(csv_reader, self.chunk_size, start_chunk, end_chunk)):
-            cols = self.columns.lower()
-            query = "insert into {table_name} (the_geom,{columns}) values".\
-                format(table_name=self.table_name, columns=cols)
-            for record in record_chunk:
-                query += " (" + self.create_geom_query(record)
-                for column in self.columns.split(","):
-                    query += self.parse_column_value(record, column)
-                query = query[:-1] + "),"
-
-            query = query[:-1]
-            self.send(query, self.file_encoding, chunk_num)
+        self.notify_total_rows(stream, int(self.chunk_size))
+        self.insert_table_name = None
+        if self.staging:
+            # The swap is a Batch SQL job with CARTO functions, which can be
+            # neither exported nor run on a local PostgreSQL
+            if self.sink is not None:
+                raise ValueError("staging cannot be used with sql_output_dir or postgres_dsn")
+            if start_chunk != 1 or end_chunk is not None:
+                raise ValueError("staging loads the whole file, start_chunk and end_chunk cannot be used")
+            self.insert_table_name = self.get_staging_table_name()
+            self.create_staging_table()
+            if self.failed_chunks:
+                return
+
+        self.send_chunks(stream, start_chunk, end_chunk)
+
+        if self.staging:
+            self.flush()
+            if self.failed_chunks:
+                logger.error("{failed} chunks failed, {table} was not replaced".
+                             format(failed=len(self.failed_chunks), table=self.table_name))
+            else:
+                self.swap_staging_table()
+
+    def build_query(self, record_chunk):
+        return self.build_insert_query(record_chunk, self.insert_table_name)
 
 
 class UpdateJob(UploadJob):
@@ -318,37 +1135,27 @@ class UpdateJob(UploadJob):
         super(UpdateJob, self).__init__(*args, **kwargs)
 
     def do_run(self, stream, start_row=1, end_row=None):
-        import ipdb; ipdb.set_trace(context=30)
-        self.notify('total_rows', _count(stream))
-        csv_reader = InsensitiveDictReader(stream, delimiter=self.delimiter)
-
-        for row_num, record in enumerate(csv_reader):
-            if row_num < (start_row - 1):
-                continue
+        self.notify_total_rows(stream)
+        self.send_chunks(stream, start_row, end_row)
 
-            if end_row is not None and row_num >= end_row:
-                break
+    def iter_chunks(self, stream, start_row, end_row):
+        # Updates are sent one row at a time
+        csv_reader = self.read_records(stream)
 
-            query = "update {table_name} set ".\
-                    format(table_name=self.table_name)
-            query += " the_geom = " + self.create_geom_query(record)
-            for column in self.columns.split(","):
-                if column == self.id_column:
+        try:
+            for row_num, record in enumerate(csv_reader):
+                if row_num < (start_row - 1):
                     continue
 
-                value = self.parse_column_value(record, column)
-                query += "{column} = ".format(column=column) + value
-            try:
-                id_value = record[self.id_column]
-                self.parse_float_value(id_value)
-            except ValueError:
-                query = query[:-1] + " where {id_column} = '{id}'".\
-                    format(id_column=self.id_column, id=id_value)
-            else:
-                query = query[:-1] + " where {id_column} = {id}".\
-                    format(id_column=self.id_column, id=id_value)
+                if end_row is not None and row_num >= end_row:
+                    break
+
+                yield row_num, [record]
+        finally:
+            close_iterator(csv_reader)
 
-            self.send(query, self.file_encoding, row_num)
+    def build_query(self, record_chunk):
+        return self.build_update_query(record_chunk[0])
 
 
 class DeleteJob(UploadJob):
@@ -357,16 +1164,100 @@ class DeleteJob(UploadJob):
         super(DeleteJob, self).__init__(*args, **kwargs)
 
     def do_run(self, stream, start_chunk, end_chunk):
-        self.notify('total_rows', _count(stream) / int(self.chunk_size))
-        csv_reader = InsensitiveDictReader(stream, delimiter=self.delimiter)
-
-        for chunk_num, record_chunk in enumerate(
-                chunks(csv_reader, self.chunk_size, start_chunk, end_chunk)):
-            id_column = self.id_column.lower()
-            query = "delete from {table_name} where {column} in (".\
-                format(table_name=self.table_name, column=id_column)
-            for record in record_chunk:
-                query += self.parse_column_value(record, self.id_column)
-            query = query[:-1] + ")"
-
-            self.send(query, self.file_encoding, chunk_num)
+        self.notify_total_rows(stream, int(self.chunk_size))
+        self.send_chunks(stream, start_chunk, end_chunk)
+
+    def build_query(self, record_chunk):
+        return self.build_delete_chunk_query(record_chunk)
+
+
+class SyncJob(UploadJob):
+    # Compares the CSV against a snapshot of per-id content hashes saved by the
+    # previous run, and only sends new rows (insert), changed rows (update) and
+    # rows missing from the CSV (delete). The snapshot is replaced only if
+    # every chunk was sent successfully. Ids must be unique, so rows are
+    # deduplicated, by default keeping the last row of each id
+
+    def __init__(self, id_column, *args, **kwargs):
+        self.id_column = id_column
+        self.snapshot_file = DEFAULT_SNAPSHOT_FILE
+        kwargs.setdefault("dedup", DEDUP_LAST)
+        super(SyncJob, self).__init__(*args, **kwargs)
+        if self.snapshot_file is None:
+            self.snapshot_file = "{table_name}.snapshot".format(table_name=self.table_name)
+
+    def do_run(self, stream, start_chunk=1, end_chunk=None):
+        if not self.dedup:
+            raise ValueError("SyncJob requires dedup, since a repeated id would be inserted twice")
+        self.inserted_rows = 0
+        self.updated_rows = 0
+        self.deleted_rows = 0
+        self.failed_chunks = []
+        self.chunk_num = 0
+
+        with Snapshot(self.snapshot_file) as snapshot:
+            inserted = []
+            for record in self.read_records(stream):
+                id_value = self.get_id_value(record)
+                if id_value is None:
+                    continue
+                hash_value = self.hash_record(record)
+                previous_hash = snapshot.get(id_value)
+                snapshot.put(id_value, hash_value)
+
+                if previous_hash is None:
+                    inserted.append(record)
+                    if len(inserted) >= self.chunk_size:
+                        self.send_next(self.build_insert_query(inserted))
+                        self.inserted_rows += len(inserted)
+                        inserted = []
+                elif previous_hash != hash_value:
+                    self.send_next(self.build_update_query(record))
+                    self.updated_rows += 1
+            if inserted:
+                self.send_next(self.build_insert_query(inserted))
+                self.inserted_rows += len(inserted)
+
+            deleted = []
+            for id_value in snapshot.removed_ids():
+                deleted.append({self.id_column: id_value})
+                if len(deleted) >= self.chunk_size:
+                    self.send_next(self.build_delete_chunk_query(deleted))
+                    self.deleted_rows += len(deleted)
+                    deleted = []
+            if deleted:
+                self.send_next(self.build_delete_chunk_query(deleted))
+                self.deleted_rows += len(deleted)
+
+            self.flush()
+            logger.info("Sync: {inserted} new, {updated} changed, {deleted} removed rows".
+                        format(inserted=self.inserted_rows, updated=self.updated_rows, deleted=self.deleted_rows))
+            if self.failed_chunks:
+                logger.error("Sync: {failed} chunks failed, keeping previous snapshot".
+                             format(failed=len(self.failed_chunks)))
+            else:
+                snapshot.commit()
+
+    def send_next(self, query):
+        self.send(query, self.file_encoding, self.chunk_num)
+        self.chunk_num += 1
+
+    def hash_record(self, record):
+        columns = self.columns.split(",")
+        if self.force_the_geom:
+            columns.append(self.force_the_geom)
+        elif not self.force_no_geometry:
+            columns.extend([self.x_column, self.y_column])
+
+        # Typed values, from Parquet or Arrow files, are hashed as their SQL literals
+        typed = isinstance(record, TypedRecord)
+        values = []
+        for column in columns:
+            try:
+                value = record[column]
+            except KeyError:
+                value = None
+            if typed and value is not None:
+                value = self.format_typed_value(value)
+            values.append(value)
+        return content_hash(values)
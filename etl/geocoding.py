@@ -6,6 +6,7 @@ if sys.version_info >= (3, 0):
 else:
     import ConfigParser
 import requests
+from builtins import range
 from os.path import dirname, join
 from datetime import datetime
 from lxml import etree
@@ -18,30 +19,93 @@ from carto.sql import SQLClient
 
 logger = logging.getLogger(__name__)
 
-config = ConfigParser.RawConfigParser()
-config.read("etl.conf")
+HERE_API_URL = "https://batch.geocoder.cit.api.here.com/6.2/jobs/"
+DEFAULT_CONFIG_FILE = "etl.conf"
 
-HERE_APP_CODE = config.get('here', 'app_code')
-HERE_APP_ID = config.get('here', 'app_id')
-CARTO_BASE_URL = config.get('carto', 'base_url')
-CARTO_API_KEY = config.get('carto', 'api_key')
-MAX_ATTEMPTS = int(config.get('etl', 'max_attempts'))
-INPUT_DELIMITER = config.get('geocoding', 'input_delimiter')
-OUTPUT_DELIMITER = config.get('geocoding', 'output_delimiter')
-OUTPUT_COLUMNS = config.get('geocoding', 'output_columns')
-MAX_RESULTS = int(config.get('geocoding', 'max_results'))
 
-HERE_API_URL = "https://batch.geocoder.cit.api.here.com/6.2/jobs/"
+class GeocodingContext(object):
+    # Holds the geocoding configuration and the clients built from it. The config
+    # file is only read when the first setting is needed, and the SQL client is
+    # only created on first use, so importing this module has no side effects
+
+    def __init__(self, config_file=DEFAULT_CONFIG_FILE, **settings):
+        self.config_file = config_file
+        self.settings = settings
+        self._config = None
+        self._sql = None
+
+    @property
+    def config(self):
+        if self._config is None:
+            self._config = ConfigParser.RawConfigParser()
+            if self.config_file is not None:
+                self._config.read(self.config_file)
+        return self._config
+
+    def get(self, section, key):
+        if key in self.settings:
+            return self.settings[key]
+        return self.config.get(section, key)
+
+    @property
+    def here_app_code(self):
+        return self.get('here', 'app_code')
+
+    @property
+    def here_app_id(self):
+        return self.get('here', 'app_id')
+
+    @property
+    def carto_base_url(self):
+        return self.get('carto', 'base_url')
+
+    @property
+    def carto_api_key(self):
+        return self.get('carto', 'api_key')
+
+    @property
+    def max_attempts(self):
+        return int(self.get('etl', 'max_attempts'))
+
+    @property
+    def input_delimiter(self):
+        return self.get('geocoding', 'input_delimiter')
+
+    @property
+    def output_delimiter(self):
+        return self.get('geocoding', 'output_delimiter')
+
+    @property
+    def output_columns(self):
+        return self.get('geocoding', 'output_columns')
+
+    @property
+    def max_results(self):
+        return int(self.get('geocoding', 'max_results'))
+
+    @property
+    def sql(self):
+        if self._sql is None:
+            self._sql = SQLClient(APIKeyAuthClient(self.carto_base_url, self.carto_api_key))
+        return self._sql
+
+
+_default_context = None
 
 
-sql = SQLClient(APIKeyAuthClient(CARTO_BASE_URL, CARTO_API_KEY))
+def get_default_context():
+    global _default_context
+    if _default_context is None:
+        _default_context = GeocodingContext()
+    return _default_context
 
 
 class HereGeocodingJob(object):
     request_id = None
     status = None
 
-    def __init__(self, csv_file_path=None, email=None, request_id=None):
+    def __init__(self, csv_file_path=None, email=None, request_id=None, context=None):
+        self.context = context or get_default_context()
         if request_id is not None:
             self.request_id = request_id
             self.target_dir = "."
@@ -52,14 +116,14 @@ class HereGeocodingJob(object):
                 "action": "run",
                 "gen": 9,
                 "header": True,
-                "indelim": INPUT_DELIMITER,
-                "outdelim": OUTPUT_DELIMITER,
+                "indelim": self.context.input_delimiter,
+                "outdelim": self.context.output_delimiter,
                 "mailto": email,
-                "outcols": OUTPUT_COLUMNS,
+                "outcols": self.context.output_columns,
                 "outputCombined": False,
-                "maxresults": MAX_RESULTS,
-                "app_code": HERE_APP_CODE,
-                "app_id": HERE_APP_ID
+                "maxresults": self.context.max_results,
+                "app_code": self.context.here_app_code,
+                "app_id": self.context.here_app_id
             }
 
             with open(csv_file_path) as csv_file:
@@ -76,8 +140,8 @@ class HereGeocodingJob(object):
     def refresh(self):
         params = {
             "action": "status",
-            "app_code": HERE_APP_CODE,
-            "app_id": HERE_APP_ID
+            "app_code": self.context.here_app_code,
+            "app_id": self.context.here_app_id
         }
 
         r = requests.get(HERE_API_URL + "{request_id}".format(request_id=self.request_id), params=params)
@@ -87,8 +151,8 @@ class HereGeocodingJob(object):
 
     def download(self):
         params = {
-            "app_code": HERE_APP_CODE,
-            "app_id": HERE_APP_ID
+            "app_code": self.context.here_app_code,
+            "app_id": self.context.here_app_id
         }
 
         r = requests.get(HERE_API_URL + "{request_id}/all".format(request_id=self.request_id), params=params)
@@ -105,9 +169,9 @@ class HereGeocodingJob(object):
                 with ZipFile("{file_path_without_extension}sss.zip".format(file_path_without_extension=join(self.target_dir, self.request_id)), "w") as clean_zipfile:
                     for zipinfo in zipinfos:
                         if zipinfo.filename.endswith("_out.txt") or zipinfo.filename.endswith("_err.txt"):
-                            csv_reader = csv.DictReader(original_zipfile.open(zipinfo.filename), delimiter=OUTPUT_DELIMITER)
+                            csv_reader = csv.DictReader(original_zipfile.open(zipinfo.filename), delimiter=self.context.output_delimiter)
                             with BytesIO() as clean_csv:
-                                csv_writer = csv.writer(clean_csv, delimiter=OUTPUT_DELIMITER)
+                                csv_writer = csv.writer(clean_csv, delimiter=self.context.output_delimiter)
                                 csv_writer.writerow(self.__get_output_columns__())
                                 for row in csv_reader:
                                     csv_writer.writerow(self.__get_row__(row))
@@ -116,7 +180,7 @@ class HereGeocodingJob(object):
                             clean_zipfile.writestr(zipinfo.filename, original_zipfile.read(zipinfo.filename))
 
     def __get_output_columns__(self):
-        return OUTPUT_COLUMNS.split(",")
+        return self.context.output_columns.split(",")
 
     def __get_row__(self, row):
         columns = self.__get_output_columns__()
@@ -130,8 +194,9 @@ class HereGeocodingJob(object):
 
 
 class CartoGeocodingJob(object):
-    def __init__(self, csv_file_path):
+    def __init__(self, csv_file_path, context=None):
         self.csv_file_path = csv_file_path
+        self.context = context or get_default_context()
 
     def download(self):
         target_dir = dirname(self.csv_file_path)
@@ -144,9 +209,9 @@ class CartoGeocodingJob(object):
             for row_num, record in enumerate(csv_reader):
                 query = "with geocoding as (select cdb_geocode_street_point('{address}', country => '{country}') as the_geom) select st_x(the_geom) as longitude, " \
                         "st_y(the_geom) as latitude from geocoding".format(address=record["searchText"], country=record["country"])
-                for retry in xrange(MAX_ATTEMPTS):
+                for retry in range(self.context.max_attempts):
                     try:
-                        q = sql.send(query)
+                        q = self.context.sql.send(query)
                     except Exception as e:
                         logger.error("Row #{row_num}: Retry ({error_msg})".format(row_num=(row_num + 1), error_msg=e))
                     else:
@@ -0,0 +1,128 @@
+import io
+import bz2
+import gzip
+import mmap
+import codecs
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+GZIP_MAGIC = b"\x1f\x8b"
+BZ2_MAGIC = b"BZh"
+XZ_MAGIC = b"\xfd7zXZ\x00"
+COMPRESSED_TYPES = (gzip.GzipFile, bz2.BZ2File) + ((lzma.LZMAFile,) if lzma is not None else ())
+
+# UTF-32 BOMs go first since the little-endian one starts like the UTF-16 one
+BOMS = (
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+
+
+class MmapRawIO(io.RawIOBase):
+    # Read-only raw stream over a memory-mapped file. Reads copy straight from
+    # the map into the caller's buffer, through a memoryview of the map
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self.file.close()
+            raise
+        self.view = memoryview(self.map)
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        end = min(self.position + len(buffer), len(self.view))
+        size = end - self.position
+        buffer[:size] = self.view[self.position:end]
+        self.position = end
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        if offset < 0:
+            raise ValueError("negative seek position {offset}".format(offset=offset))
+        self.position = offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if not self.closed:
+            self.view.release()
+            self.map.close()
+            self.file.close()
+        super(MmapRawIO, self).close()
+
+
+def is_compressed(stream):
+    # Whether a stream returned by open_input decompresses its file
+    raw = getattr(getattr(stream, "buffer", None), "raw", None)
+    return isinstance(raw, COMPRESSED_TYPES)
+
+
+def detect_compression(path):
+    with open(path, "rb") as f:
+        magic = f.read(len(XZ_MAGIC))
+    if magic.startswith(GZIP_MAGIC):
+        return "gzip"
+    if magic.startswith(BZ2_MAGIC):
+        return "bz2"
+    if magic.startswith(XZ_MAGIC):
+        return "xz"
+    return None
+
+
+def detect_bom(head):
+    for bom, encoding in BOMS:
+        if head.startswith(bom):
+            return encoding
+    return None
+
+
+def open_binary(path, buffer_size=DEFAULT_BUFFER_SIZE, use_mmap=False):
+    compression = detect_compression(path)
+    if compression == "gzip":
+        raw = gzip.GzipFile(path, "rb")
+    elif compression == "bz2":
+        raw = bz2.BZ2File(path, "rb")
+    elif compression == "xz":
+        if lzma is None:
+            raise ValueError("xz-compressed input requires the lzma module")
+        raw = lzma.LZMAFile(path, "rb")
+    elif use_mmap:
+        try:
+            raw = MmapRawIO(path)
+        except (ValueError, EnvironmentError):
+            # Empty files cannot be mapped
+            raw = io.FileIO(path, "rb")
+    else:
+        raw = io.FileIO(path, "rb")
+    return io.BufferedReader(raw, buffer_size)
+
+
+def open_input(path, encoding="utf-8", buffer_size=DEFAULT_BUFFER_SIZE, use_mmap=False):
+    # Opens a CSV file for reading as text, decompressing gzip, bz2 and xz
+    # files on the fly and decoding incrementally from large buffered reads.
+    # A byte order mark, if any, takes precedence over the given encoding
+    binary = open_binary(path, buffer_size, use_mmap)
+    encoding = detect_bom(binary.peek(4)[:4]) or encoding
+    return io.TextIOWrapper(binary, encoding=encoding, newline="")
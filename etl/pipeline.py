@@ -0,0 +1,177 @@
+import time
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger('carto-etl')
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_QUEUE_SIZE = 16
+
+_END = object()
+
+
+class PipelineClosed(Exception):
+    pass
+
+
+class BoundedQueue(object):
+    # FIFO queue bounded both in number of items and in their total size in
+    # bytes. An item bigger than max_bytes is still accepted when the queue is
+    # empty, so that a single huge chunk cannot block the pipeline forever
+
+    def __init__(self, max_items=DEFAULT_QUEUE_SIZE, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.items = deque()
+        self.bytes = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def put(self, item, size=0):
+        with self.condition:
+            while not self.closed and self.items and \
+                    (len(self.items) >= self.max_items or self.bytes + size > self.max_bytes):
+                self.condition.wait()
+            if self.closed:
+                raise PipelineClosed
+            self.items.append((item, size))
+            self.bytes += size
+            self.condition.notify_all()
+
+    def get(self):
+        with self.condition:
+            while not self.closed and not self.items:
+                self.condition.wait()
+            if not self.items:
+                raise PipelineClosed
+            item, size = self.items.popleft()
+            self.bytes -= size
+            self.condition.notify_all()
+            return item
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class StageStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.start = None
+        self.end = None
+
+    @property
+    def elapsed(self):
+        if self.start is None:
+            return 0.0
+        return (self.end or time.time()) - self.start
+
+    @property
+    def utilization(self):
+        return self.busy / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self):
+        return {"stage": self.name, "items": self.items, "busy": self.busy,
+                "elapsed": self.elapsed, "utilization": self.utilization}
+
+    def __str__(self):
+        return "{name}: {items} items, {busy:.2f}s busy, {utilization:.0%} utilization".\
+            format(name=self.name, items=self.items, busy=self.busy, utilization=self.utilization)
+
+
+class Pipeline(object):
+    # Runs reader, transformer and sender stages in separate threads connected
+    # by bounded queues, so a slow stage makes the previous ones wait instead of
+    # piling up data in memory. max_bytes is shared by both queues.
+    #
+    # reader is an iterable of (chunk_num, chunk), transform turns a chunk into
+    # a query and send gets (query, chunk_num). chunk_size and query_size
+    # estimate the bytes of chunks and queries
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, queue_size=DEFAULT_QUEUE_SIZE):
+        self.chunks = BoundedQueue(queue_size, max_bytes // 2)
+        self.queries = BoundedQueue(queue_size, max_bytes // 2)
+        self.stats = [StageStats("reader"), StageStats("transformer"), StageStats("sender")]
+        self.error = None
+
+    def run(self, reader, transform, send, chunk_size=len, query_size=len):
+        threads = [
+            threading.Thread(target=self.run_stage, args=(self.stats[0], self.read, reader, chunk_size)),
+            threading.Thread(target=self.run_stage, args=(self.stats[1], self.transform, transform, query_size)),
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        self.run_stage(self.stats[2], self.send, send)
+        for thread in threads:
+            thread.join()
+
+        for stats in self.stats:
+            logger.info("Pipeline {stats}".format(stats=stats))
+        if self.error is not None:
+            raise self.error
+        return self.stats
+
+    def run_stage(self, stats, target, *args):
+        stats.start = time.time()
+        try:
+            target(stats, *args)
+        except PipelineClosed:
+            pass
+        except Exception as e:
+            self.error = self.error or e
+            self.chunks.close()
+            self.queries.close()
+        finally:
+            stats.end = time.time()
+
+    def read(self, stats, reader, chunk_size):
+        # The reader is closed in this thread when the stage ends, also if
+        # another stage failed, so that it releases what it holds (e.g. files
+        # or connections that can only be used from the thread that opened them)
+        iterator = iter(reader)
+        try:
+            while True:
+                start = time.time()
+                try:
+                    chunk_num, chunk = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    stats.busy += time.time() - start
+                stats.items += 1
+                self.chunks.put((chunk_num, chunk), chunk_size(chunk))
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+        self.chunks.put(_END)
+
+    def transform(self, stats, transform, query_size):
+        while True:
+            item = self.chunks.get()
+            if item is _END:
+                break
+            chunk_num, chunk = item
+            start = time.time()
+            query = transform(chunk)
+            stats.busy += time.time() - start
+            stats.items += 1
+            self.queries.put((chunk_num, query), query_size(query))
+        self.queries.put(_END)
+
+    def send(self, stats, send):
+        while True:
+            item = self.queries.get()
+            if item is _END:
+                break
+            chunk_num, query = item
+            start = time.time()
+            send(query, chunk_num)
+            stats.busy += time.time() - start
+            stats.items += 1
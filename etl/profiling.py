@@ -0,0 +1,175 @@
+import io
+import sys
+import time
+import pstats
+import cProfile
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+logger = logging.getLogger('carto-etl')
+
+PSTATS_FORMAT = "pstats"
+COLLAPSED_FORMAT = "collapsed"
+DEFAULT_SAMPLE_CHUNKS = 10
+DEFAULT_SAMPLE_EVERY = 1
+DEFAULT_SAMPLING_INTERVAL = 0.005
+DEFAULT_TOP_FUNCTIONS = 15
+
+
+class StageProfile(object):
+    def __init__(self, name):
+        self.name = name
+        self.chunks = 0
+        self.seconds = 0.0
+        self.peak_memory = 0
+
+    def __str__(self):
+        return "{name}: {chunks} chunks, {seconds:.3f}s, {peak:.1f} KB peak allocation".format(
+            name=self.name, chunks=self.chunks, seconds=self.seconds, peak=self.peak_memory / 1024.0)
+
+
+class Profiler(object):
+    # Profiles a sample of the chunks of a job: profile_chunks of them, one out
+    # of every sample_every. Functions are profiled with cProfile (pstats
+    # output) or with a stack-sampling thread (collapsed stacks output, as used
+    # by flame graph tools), and the allocation peak of each stage (parse,
+    # serialize, send) is measured with tracemalloc. tracemalloc only runs
+    # during the stages of the sampled chunks, so the rest pay no tracing cost
+
+    def __init__(self, output_file, output_format=PSTATS_FORMAT, sample_chunks=DEFAULT_SAMPLE_CHUNKS,
+                 sample_every=DEFAULT_SAMPLE_EVERY, trace_memory=True, sampling_interval=DEFAULT_SAMPLING_INTERVAL):
+        if output_format not in (PSTATS_FORMAT, COLLAPSED_FORMAT):
+            raise ValueError("Unknown profile format: {output_format}".format(output_format=output_format))
+        self.output_file = output_file
+        self.output_format = output_format
+        self.sample_chunks = sample_chunks
+        self.sample_every = max(sample_every, 1)
+        self.trace_memory = trace_memory and tracemalloc is not None
+        self.sampling_interval = sampling_interval
+        self.profile = cProfile.Profile() if output_format == PSTATS_FORMAT else None
+        self.stacks = Counter()
+        self.stages = {}
+        self.chunk_index = -1
+        self.sampled_chunks = 0
+        self.sampling = threading.Event()
+        self.stopped = False
+        self.sampler = None
+        self.thread_id = None
+
+    def start(self):
+        self.thread_id = threading.current_thread().ident
+        if self.output_format == COLLAPSED_FORMAT:
+            self.stopped = False
+            self.sampler = threading.Thread(target=self.sample_stacks)
+            self.sampler.daemon = True
+            self.sampler.start()
+
+    def stop(self):
+        if self.sampler is not None:
+            self.stopped = True
+            self.sampling.set()
+            self.sampler.join()
+            self.sampler = None
+
+    def next_chunk(self):
+        # Whether the next chunk is profiled
+        self.chunk_index += 1
+        sampled = self.sampled_chunks < self.sample_chunks and self.chunk_index % self.sample_every == 0
+        if sampled:
+            self.sampled_chunks += 1
+        return sampled
+
+    def discard_chunk(self, sampled, stage_name):
+        # Undoes next_chunk when there turned out to be no chunk left, whose
+        # last attempt to read counts as time of stage_name but not as a chunk
+        self.chunk_index -= 1
+        if sampled:
+            self.sampled_chunks -= 1
+            self.stages[stage_name].chunks -= 1
+
+    @contextmanager
+    def stage(self, name, sampled):
+        if not sampled:
+            yield
+            return
+
+        stage = self.stages.setdefault(name, StageProfile(name))
+        started_tracemalloc = self.trace_memory and not tracemalloc.is_tracing()
+        if started_tracemalloc:
+            tracemalloc.start()
+        elif self.trace_memory and hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0] if self.trace_memory else 0
+        start = time.time()
+        self.enable()
+        try:
+            yield
+        finally:
+            self.disable()
+            stage.seconds += time.time() - start
+            stage.chunks += 1
+            if self.trace_memory:
+                stage.peak_memory = max(stage.peak_memory, tracemalloc.get_traced_memory()[1] - start_memory)
+            if started_tracemalloc:
+                tracemalloc.stop()
+
+    def enable(self):
+        if self.profile is not None:
+            self.profile.enable()
+        else:
+            self.sampling.set()
+
+    def disable(self):
+        if self.profile is not None:
+            self.profile.disable()
+        else:
+            self.sampling.clear()
+
+    def sample_stacks(self):
+        while True:
+            self.sampling.wait()
+            if self.stopped:
+                return
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{function} ({filename}:{line})".format(
+                    function=code.co_name, filename=code.co_filename, line=code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.sampling_interval)
+
+    def write(self):
+        if self.profile is not None:
+            self.profile.dump_stats(self.output_file)
+        else:
+            with io.open(self.output_file, "w") as f:
+                for stack, count in sorted(self.stacks.items()):
+                    f.write(u"{stack} {count}\n".format(stack=stack, count=count))
+
+    def summary(self, top=DEFAULT_TOP_FUNCTIONS):
+        lines = ["Profiled {sampled} of {total} chunks, written to {output_file}".format(
+            sampled=self.sampled_chunks, total=self.chunk_index + 1, output_file=self.output_file)]
+        lines.extend(str(self.stages[name]) for name in sorted(self.stages))
+
+        if self.profile is not None and self.profile.getstats():
+            output = io.StringIO() if sys.version_info >= (3, 0) else io.BytesIO()
+            stats = pstats.Stats(self.profile, stream=output)
+            stats.sort_stats("cumulative").print_stats(top)
+            lines.append(output.getvalue())
+        elif self.profile is None:
+            functions = Counter()
+            for stack, count in self.stacks.items():
+                functions[stack.rsplit(";", 1)[-1]] += count
+            lines.append("Top functions by samples:")
+            lines.extend("{count:8} {function}".format(count=count, function=function)
+                         for function, count in functions.most_common(top))
+        return "\n".join(lines)
@@ -0,0 +1,55 @@
+import math
+from array import array
+try:
+    import pyproj
+except ImportError:
+    pyproj = None
+
+WGS84_SRID = 4326
+
+
+class Reprojector(object):
+    # Transforms coordinates from a source SRID to EPSG:4326 a whole chunk at a
+    # time with pyproj. Only non-finite coordinates, and those whose transform
+    # is not finite, are rejected. Coordinates are valid outside the area of
+    # use of many CRSs (e.g. EPSG:25830 is used for the whole of Spain), so
+    # checking it is optional: with area_margin, coordinates further than that
+    # fraction of the width or height of the area of use, expressed in the
+    # source CRS, are rejected too
+
+    def __init__(self, srid, area_margin=None):
+        if pyproj is None:
+            raise ValueError("Client-side reprojection requires pyproj")
+        self.srid = int(srid)
+        crs = pyproj.CRS.from_epsg(self.srid)
+        self.transformer = pyproj.Transformer.from_crs(crs, WGS84_SRID, always_xy=True)
+        self.bounds = None
+        if area_margin is not None and crs.area_of_use is not None:
+            min_x, min_y, max_x, max_y = pyproj.Transformer.from_crs(WGS84_SRID, crs, always_xy=True).\
+                transform_bounds(*crs.area_of_use.bounds)
+            margin_x = (max_x - min_x) * float(area_margin)
+            margin_y = (max_y - min_y) * float(area_margin)
+            self.bounds = (min_x - margin_x, min_y - margin_y, max_x + margin_x, max_y + margin_y)
+
+    def is_valid(self, x, y):
+        if x is None or y is None or math.isnan(x) or math.isnan(y) or math.isinf(x) or math.isinf(y):
+            return False
+        if self.bounds is None:
+            return True
+        min_x, min_y, max_x, max_y = self.bounds
+        return min_x <= x <= max_x and min_y <= y <= max_y
+
+    def transform(self, xs, ys):
+        # Returns a (longitude, latitude) tuple per input coordinate, or None
+        # for the invalid ones
+        valid = [position for position, (x, y) in enumerate(zip(xs, ys)) if self.is_valid(x, y)]
+        points = [None] * len(xs)
+        if not valid:
+            return points
+
+        longitudes, latitudes = self.transformer.transform(array("d", (xs[position] for position in valid)),
+                                                           array("d", (ys[position] for position in valid)))
+        for position, longitude, latitude in zip(valid, longitudes, latitudes):
+            if not (math.isinf(longitude) or math.isinf(latitude) or math.isnan(longitude) or math.isnan(latitude)):
+                points[position] = (longitude, latitude)
+        return points
@@ -0,0 +1,246 @@
+"""
+Runs many ETL jobs defined in a single configuration file on a shared pool of
+worker threads:
+
+    carto-etl etl.conf [--jobs samples,other] [--workers 8] [--profile DIR]
+
+Every [job:<name>] section defines a job with an `action` (insert, update,
+delete or sync), a `file` and any other job parameter, such as `table_name`,
+`columns` or `id_column`. The [carto] and [etl] sections hold the defaults for
+all the jobs, and [runner] the pool settings: `workers`, the maximum number of
+jobs running at the same time, and `max_requests_per_second`, per CARTO account.
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import threading
+from multiprocessing.pool import ThreadPool
+try:
+    import ConfigParser
+except ImportError:
+    import configparser as ConfigParser
+
+from carto.auth import APIKeyAuthClient
+from carto.sql import SQLClient
+from carto.sql import BatchSQLClient
+
+from .etl import InsertJob, UpdateJob, DeleteJob, SyncJob
+from .profiling import PSTATS_FORMAT, COLLAPSED_FORMAT
+
+logger = logging.getLogger('carto-etl')
+
+JOB_SECTION_PREFIX = "job:"
+RUNNER_SECTION = "runner"
+LOG_SECTION = "log"
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_REQUESTS_PER_SECOND = 0
+
+JOB_CLASSES = {
+    "insert": InsertJob,
+    "update": UpdateJob,
+    "delete": DeleteJob,
+    "sync": SyncJob,
+}
+ID_COLUMN_ACTIONS = ("update", "delete", "sync")
+PROFILE_EXTENSIONS = {PSTATS_FORMAT: ".prof", COLLAPSED_FORMAT: ".collapsed"}
+
+
+class RateLimiter(object):
+    # Token bucket shared by every job of the same CARTO account. A rate of 0
+    # disables the limit
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Account(object):
+    # API clients and rate limiter shared by the jobs of a CARTO account
+
+    def __init__(self, base_url, api_key, max_requests_per_second):
+        self.rate_limiter = RateLimiter(max_requests_per_second)
+        self.sql = None
+        self.bsql = None
+        if api_key:
+            auth_client = APIKeyAuthClient(base_url, api_key)
+            self.sql = SQLClient(auth_client)
+            self.bsql = BatchSQLClient(auth_client)
+
+
+class JobRunner(object):
+    def __init__(self, config, workers=None, job_names=None, profile_dir=None, profile_format=PSTATS_FORMAT,
+                 profile_chunks=None):
+        self.config = config
+        self.workers = workers or self.get_runner_option("workers", DEFAULT_WORKERS)
+        self.max_requests_per_second = self.get_runner_option("max_requests_per_second",
+                                                              DEFAULT_MAX_REQUESTS_PER_SECOND)
+        self.job_names = job_names
+        self.profile_dir = profile_dir
+        self.profile_format = profile_format
+        self.profile_chunks = profile_chunks
+        self.accounts = {}
+        self.accounts_lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, config_file, **kwargs):
+        config = ConfigParser.RawConfigParser()
+        if not config.read(config_file):
+            raise ValueError("Could not read {config_file}".format(config_file=config_file))
+        return cls(config, **kwargs)
+
+    def get_runner_option(self, option, default):
+        if self.config.has_option(RUNNER_SECTION, option):
+            return int(self.config.get(RUNNER_SECTION, option))
+        return default
+
+    def get_job_sections(self):
+        sections = [section for section in self.config.sections() if section.startswith(JOB_SECTION_PREFIX)]
+        if self.job_names is not None:
+            sections = [section for section in sections if section[len(JOB_SECTION_PREFIX):] in self.job_names]
+        return sections
+
+    def get_defaults(self):
+        defaults = {}
+        for section in self.config.sections():
+            if section.startswith(JOB_SECTION_PREFIX) or section in (RUNNER_SECTION, LOG_SECTION):
+                continue
+            defaults.update(self.config.items(section))
+        return defaults
+
+    def get_account(self, base_url, api_key):
+        # Called from the pool threads, so that every job of an account gets
+        # the same Account
+        key = (base_url, api_key)
+        with self.accounts_lock:
+            if key not in self.accounts:
+                self.accounts[key] = Account(base_url, api_key, self.max_requests_per_second)
+            return self.accounts[key]
+
+    def create_job(self, section):
+        kwargs = self.get_defaults()
+        kwargs.update(self.config.items(section))
+        name = section[len(JOB_SECTION_PREFIX):]
+        kwargs.setdefault("table_name", name)
+        action = kwargs.pop("action", "insert")
+        file_path = kwargs.pop("file")
+        try:
+            job_class = JOB_CLASSES[action]
+        except KeyError:
+            raise ValueError("Job {name}: unknown action {action}".format(name=name, action=action))
+
+        account = self.get_account(kwargs.get("base_url"), kwargs.get("api_key"))
+        kwargs.update(sql=account.sql, bsql=account.bsql, rate_limiter=account.rate_limiter)
+        if self.profile_dir:
+            kwargs.update(profile_file=os.path.join(self.profile_dir, name + PROFILE_EXTENSIONS[self.profile_format]),
+                          profile_format=self.profile_format)
+            if self.profile_chunks:
+                kwargs["profile_chunks"] = self.profile_chunks
+        if action in ID_COLUMN_ACTIONS:
+            return job_class(kwargs.pop("id_column"), file_path, **kwargs)
+        return job_class(file_path, **kwargs)
+
+    def run_job(self, section):
+        name = section[len(JOB_SECTION_PREFIX):]
+        summary = {"job": name, "table": None, "rows": 0, "seconds": 0.0, "failed_chunks": 0, "error": None}
+        start = time.time()
+        try:
+            job = self.create_job(section)
+            summary["table"] = job.table_name
+            logger.info("Job {name}: starting".format(name=name))
+            job.run()
+        except Exception as e:
+            logger.exception("Job {name}: failed".format(name=name))
+            summary["error"] = str(e)
+        else:
+            summary["rows"] = job.processed_rows
+            summary["failed_chunks"] = len(job.failed_chunks)
+        summary["seconds"] = time.time() - start
+        summary["rows_per_second"] = summary["rows"] / summary["seconds"] if summary["seconds"] else 0.0
+        return summary
+
+    def run(self):
+        sections = self.get_job_sections()
+        pool = ThreadPool(self.workers)
+        try:
+            summaries = pool.map(self.run_job, sections, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        self.log_summary(summaries)
+        return summaries
+
+    def log_summary(self, summaries):
+        logger.info("{job:20} {table:20} {rows:>10} {seconds:>9} {rate:>10} {failed:>7}".format(
+            job="job", table="table", rows="rows", seconds="seconds", rate="rows/s", failed="failed"))
+        for summary in summaries:
+            logger.info("{job:20} {table:20} {rows:>10} {seconds:>9.1f} {rate:>10.1f} {failed:>7} {error}".format(
+                job=summary["job"], table=summary["table"] or "", rows=summary["rows"], seconds=summary["seconds"],
+                rate=summary["rows_per_second"], failed=summary["failed_chunks"], error=summary["error"] or ""))
+
+
+def setup_logging(config):
+    logger.setLevel(logging.DEBUG)
+    if config.has_option(LOG_SECTION, "file"):
+        try:
+            fh = logging.FileHandler(config.get(LOG_SECTION, "file"))
+        except IOError:
+            pass
+        else:
+            fh.setLevel(int(config.get(LOG_SECTION, "level")) if config.has_option(LOG_SECTION, "level")
+                        else logging.DEBUG)
+            logger.addHandler(fh)
+
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
+    logger.addHandler(ch)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the ETL jobs defined in a configuration file")
+    parser.add_argument("config_file", help="Configuration file with [job:<name>] sections")
+    parser.add_argument("--jobs", help="Comma-separated names of the jobs to run. Defaults to all of them")
+    parser.add_argument("--workers", type=int, help="Maximum number of jobs running at the same time")
+    parser.add_argument("--profile", metavar="DIR",
+                        help="Profile a sample of the chunks of every job and write the results to DIR")
+    parser.add_argument("--profile-format", choices=sorted(PROFILE_EXTENSIONS), default=PSTATS_FORMAT,
+                        help="pstats (cProfile) or collapsed (sampled stacks, for flame graphs)")
+    parser.add_argument("--profile-chunks", type=int, help="Number of chunks profiled per job")
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        if not os.path.isdir(args.profile):
+            os.makedirs(args.profile)
+        # Profilers and tracemalloc are process-wide, so jobs are profiled one
+        # at a time unless told otherwise
+        if args.workers is None:
+            args.workers = 1
+    runner = JobRunner.from_file(args.config_file, workers=args.workers,
+                                 job_names=args.jobs.split(",") if args.jobs else None,
+                                 profile_dir=args.profile, profile_format=args.profile_format,
+                                 profile_chunks=args.profile_chunks)
+    setup_logging(runner.config)
+    summaries = runner.run()
+    failed = any(summary["error"] or summary["failed_chunks"] for summary in summaries)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+import io
+import os
+import re
+import bz2
+import gzip
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+from .inputs import open_input
+
+SQL_FILE_PATTERN = "chunk_{chunk_num:06d}.sql"
+SQL_FILE_REGEX = re.compile(r"^chunk_(\d+)\.sql(\.gz|\.bz2|\.xz)?$")
+COMPRESSIONS = {
+    "gzip": (".gz", gzip.open),
+    "bz2": (".bz2", bz2.BZ2File),
+    "xz": (".xz", lzma.LZMAFile if lzma is not None else None),
+}
+
+
+class SQLAPISink(object):
+    # Sends queries to CARTO's SQL API, the default destination of the jobs.
+    # Sinks are opened at the start of every run and closed at its end
+
+    def __init__(self, sql):
+        self.sql = sql
+
+    def open(self, resume=False):
+        pass
+
+    def send(self, query, chunk_num):
+        self.sql.send(query)
+
+    def close(self):
+        pass
+
+
+class DirectorySink(object):
+    # Writes every query to a numbered .sql file, optionally compressed, so the
+    # generated SQL can be inspected, benchmarked or replayed later with
+    # UploadJob.replay. The .sql files of a previous export are removed when
+    # opened, unless resuming it
+
+    def __init__(self, directory, compression=None):
+        if compression and (compression not in COMPRESSIONS or COMPRESSIONS[compression][1] is None):
+            raise ValueError("Unsupported compression: {compression}".format(compression=compression))
+        self.directory = directory
+        self.compression = compression or None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def open(self, resume=False):
+        if resume:
+            return
+        for filename in os.listdir(self.directory):
+            if SQL_FILE_REGEX.match(filename) is not None:
+                os.remove(os.path.join(self.directory, filename))
+
+    def get_path(self, chunk_num):
+        path = os.path.join(self.directory, SQL_FILE_PATTERN.format(chunk_num=chunk_num + 1))
+        if self.compression:
+            path += COMPRESSIONS[self.compression][0]
+        return path
+
+    def send(self, query, chunk_num):
+        if not isinstance(query, bytes):
+            query = query.encode("utf-8")
+        opener = COMPRESSIONS[self.compression][1] if self.compression else io.open
+        with opener(self.get_path(chunk_num), "wb") as f:
+            f.write(query)
+
+    def close(self):
+        pass
+
+
+class PostgresSink(object):
+    # Runs the queries against a PostgreSQL database, e.g. a local stand-in
+    # with the same table definitions as the CARTO account. The connection is
+    # only kept open during a run
+
+    def __init__(self, dsn):
+        try:
+            import psycopg2
+        except ImportError:
+            raise ValueError("PostgresSink requires psycopg2")
+        self.psycopg2 = psycopg2
+        self.dsn = dsn
+        self.connection = None
+
+    def open(self, resume=False):
+        if self.connection is None:
+            self.connection = self.psycopg2.connect(self.dsn)
+            self.connection.autocommit = True
+
+    def send(self, query, chunk_num):
+        self.open()
+        with self.connection.cursor() as cursor:
+            cursor.execute(query)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def iter_sql_files(directory, chunk_nums=None):
+    # Yields (chunk_num, query) for the files written by a DirectorySink, in
+    # order. chunk_nums optionally restricts them to some 1-based chunk numbers
+    files = []
+    for filename in os.listdir(directory):
+        match = SQL_FILE_REGEX.match(filename)
+        if match is not None:
+            files.append((int(match.group(1)), filename))
+
+    for chunk_num, filename in sorted(files):
+        if chunk_nums is not None and chunk_num not in chunk_nums:
+            continue
+        with open_input(os.path.join(directory, filename), use_mmap=False) as f:
+            yield chunk_num, f.read()
@@ -0,0 +1,86 @@
+import os
+import hashlib
+import sqlite3
+
+FIELD_SEPARATOR = b"\x1f"
+WRITE_BUFFER_SIZE = 10000
+
+
+def content_hash(values):
+    # Values are encoded one by one, so that byte and unicode strings can be
+    # mixed (on Python 2, non-ASCII byte strings cannot be joined to unicode)
+    encoded = []
+    for value in values:
+        if value is None:
+            value = b""
+        elif not isinstance(value, bytes):
+            value = value.encode("utf-8")
+        encoded.append(value)
+    return hashlib.md5(FIELD_SEPARATOR.join(encoded)).hexdigest()[:16]
+
+
+class Snapshot(object):
+    # Per-id content hashes of a previous run, stored in a local SQLite file.
+    # The hashes of the current run are written to a temporary file that only
+    # replaces the previous snapshot when commit() is called
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.conn = None
+        self.has_previous = False
+        self.buffer = []
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if self.conn is not None:
+            self.discard()
+
+    def open(self):
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        self.conn = sqlite3.connect(self.tmp_path)
+        self.conn.execute("create table snapshot (id text primary key, hash text)")
+        self.has_previous = os.path.exists(self.path)
+        if self.has_previous:
+            self.conn.execute("attach database ? as previous", (self.path,))
+
+    def get(self, id_value):
+        if not self.has_previous:
+            return None
+        row = self.conn.execute("select hash from previous.snapshot where id = ?", (id_value,)).fetchone()
+        return row[0] if row is not None else None
+
+    def put(self, id_value, hash_value):
+        self.buffer.append((id_value, hash_value))
+        if len(self.buffer) >= WRITE_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.conn.executemany("insert or replace into snapshot (id, hash) values (?, ?)", self.buffer)
+        self.buffer = []
+
+    def removed_ids(self):
+        if not self.has_previous:
+            return
+        self.flush()
+        cursor = self.conn.execute("select id from previous.snapshot where id not in (select id from main.snapshot)")
+        for row in cursor:
+            yield row[0]
+
+    def commit(self):
+        self.flush()
+        self.conn.commit()
+        self.conn.close()
+        self.conn = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(self.tmp_path, self.path)
+
+    def discard(self):
+        self.conn.close()
+        self.conn = None
+        os.remove(self.tmp_path)
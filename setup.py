@@ -14,4 +14,6 @@ setup(name="carto-etl",
       version="1.0.1",
       url="https://github.com/CartoDB/carto-etl",
       install_requires=required,
+      extras_require={"arrow": ["pyarrow"], "reproject": ["pyproj"]},
+      entry_points={"console_scripts": ["carto-etl=etl.runner:main"]},
       packages=["etl"])
@@ -191,6 +191,18 @@ def upload_job_float():
     kwargs = flatten(config_float, {})
     return UploadJob("test.csv", **kwargs)
 
+@pytest.fixture
+def job_factory():
+    # Builds jobs that keep the queries they would send in job.queries
+    def factory(job_class, *args, **kwargs):
+        job_kwargs = flatten(config, {})
+        job_kwargs.update(kwargs)
+        job = job_class(*args, **job_kwargs)
+        job.queries = []
+        job.send_sql = lambda query, file_encoding, chunk_num: job.queries.append(query)
+        return job
+    return factory
+
 @pytest.fixture(scope="session")
 def record():
     return {
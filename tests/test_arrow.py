@@ -0,0 +1,68 @@
+import datetime
+
+import pytest
+
+pyarrow = pytest.importorskip("pyarrow")
+import pyarrow.ipc
+import pyarrow.parquet
+
+from etl.etl import InsertJob, UpdateJob, DeleteJob, SyncJob
+
+
+@pytest.fixture
+def table():
+    return pyarrow.table({
+        "ID": [1, 2, 3],
+        "Name": ["a", "b'c", None],
+        "lon": [1.5, 2.0, None],
+        "lat": [2.5, 3.0, None],
+        "active": [True, False, None],
+        "date": [datetime.datetime(2017, 9, 1, 2, 47, 25), None, datetime.datetime(2017, 9, 2)],
+        "unused": ["x", "y", "z"],
+    })
+
+def test_insert_from_parquet(job_factory, table, tmp_path):
+    path = str(tmp_path / "input.parquet")
+    pyarrow.parquet.write_table(table, path)
+    job = job_factory(InsertJob, path, columns="id,name,active,date", chunk_size=2)
+    job.run()
+    assert job.queries == [
+        "insert into MYTABLE (the_geom,id,name,active,date) values "
+        "(st_transform(st_setsrid(st_makepoint(1.5, 2.5), 4326), 4326),1,'a',true,'2017-09-01 02:47:25+00'), "
+        "(st_transform(st_setsrid(st_makepoint(2.0, 3.0), 4326), 4326),2,'b''c',false,NULL)",
+        "insert into MYTABLE (the_geom,id,name,active,date) values "
+        "(NULL,3,NULL,NULL,'2017-09-02 00:00:00+00')",
+    ]
+
+def test_delete_from_arrow_file(job_factory, table, tmp_path):
+    path = str(tmp_path / "input.arrow")
+    with pyarrow.ipc.new_file(path, table.schema) as writer:
+        writer.write_table(table)
+    job = job_factory(DeleteJob, "id", path, chunk_size=10)
+    job.run()
+    assert job.queries == ["delete from MYTABLE where id in (1,2,3)"]
+
+def test_update_from_arrow_stream(job_factory, table, tmp_path):
+    path = str(tmp_path / "input.arrows")
+    with pyarrow.ipc.new_stream(path, table.schema) as writer:
+        writer.write_table(table)
+    messages = []
+    job = job_factory(UpdateJob, "id", path, columns="id,name", observer=messages.append)
+    job.run()
+    assert not [message for message in messages if message["type"] == "total_rows"]
+    assert job.queries[1] == "update MYTABLE set  the_geom = st_transform(st_setsrid(st_makepoint(2.0, 3.0), 4326), 4326),name = 'b''c' where id = 2"
+
+def test_sync_from_parquet(job_factory, table, tmp_path):
+    path = str(tmp_path / "input.parquet")
+    snapshot_file = str(tmp_path / "mytable.snapshot")
+    pyarrow.parquet.write_table(table, path)
+    job = job_factory(SyncJob, "id", path, columns="id,name,active,date", snapshot_file=snapshot_file)
+    job.run()
+    assert job.inserted_rows == 3 and job.failed_chunks == []
+
+    pyarrow.parquet.write_table(table.slice(0, 2).set_column(1, "Name", pyarrow.array(["a", "x"])), path)
+    job = job_factory(SyncJob, "id", path, columns="id,name,active,date", snapshot_file=snapshot_file)
+    job.run()
+    assert (job.inserted_rows, job.updated_rows, job.deleted_rows) == (0, 1, 1)
+    assert job.queries[0].endswith("name = 'x',active = false,date = NULL where id = 2")
+    assert job.queries[1] == "delete from MYTABLE where id in (3.0)"
@@ -1,5 +1,21 @@
+import io
+import threading
+import bz2
+import gzip
+import lzma
+import os
+import pstats
+import tempfile
+
 import pytest
 
+from etl.batch import BatchDispatcher
+from etl.dedup import IdStore
+from etl.snapshot import content_hash
+from etl.inputs import open_input
+from etl.pipeline import Pipeline, BoundedQueue, PipelineClosed
+from etl.etl import InsertJob, DeleteJob, SyncJob, InsensitiveCSVReader, ProjectedCSVReader, chunks
+
 
 def test_config_ok():
     assert 1 == 1
@@ -85,4 +101,516 @@ def test_job_observer(upload_job_observer, record):
 def test_parse_forbidden_float_column(upload_job, record):
     assert upload_job.parse_column_value(record, "forbidden_float") == "'INFINITY',"
     with pytest.raises(ValueError):
-        upload_job.parse_float_value("INFINITY")
\ No newline at end of file
+        upload_job.parse_float_value("INFINITY")
+DUPLICATED_CSV = "id,name,lon,lat\n1,a,1,2\n2,b,1,2\n1,c,1,2\n3,d,1,2\n2,e,1,2\n"
+
+def test_dedup_first(job_factory):
+    job = job_factory(DeleteJob, "id", io.StringIO(DUPLICATED_CSV), dedup="first")
+    job.run()
+    assert job.queries == ["delete from MYTABLE where id in (1.0,2.0,3.0)"]
+    assert job.skipped_rows == 2
+
+def test_dedup_last(job_factory):
+    job = job_factory(InsertJob, io.StringIO(DUPLICATED_CSV), columns="id,name", id_column="id", dedup="last")
+    job.run()
+    assert "'c'" in job.queries[0] and "'e'" in job.queries[0] and "'d'" in job.queries[0]
+    assert "'a'" not in job.queries[0] and "'b'" not in job.queries[0]
+    assert job.skipped_rows == 2
+
+def test_dedup_spills_to_disk(job_factory):
+    job = job_factory(DeleteJob, "id", io.StringIO(DUPLICATED_CSV), dedup="first", dedup_max_memory_ids=1)
+    job.run()
+    assert job.queries == ["delete from MYTABLE where id in (1.0,2.0,3.0)"]
+
+def test_dedup_requires_id_column(job_factory):
+    job = job_factory(InsertJob, io.StringIO(DUPLICATED_CSV), columns="id,name", dedup="first")
+    with pytest.raises(ValueError):
+        job.run()
+
+def test_id_store_spill():
+    with IdStore(max_memory_ids=2) as store:
+        for row_num, key in enumerate(["a", "b", "c", "d"]):
+            store[key] = row_num
+        assert store.disk is not None
+        assert store.get("a") == 0 and store.get("d") == 3
+        assert "e" not in store
+        assert len(store) == 4
+
+def test_sync_job(job_factory, tmp_path):
+    snapshot_file = str(tmp_path / "mytable.snapshot")
+    job = job_factory(SyncJob, "id", io.StringIO("id,name,lon,lat\n1,a,1,2\n2,b,1,2\n3,c,1,2\n"),
+                      columns="id,name", snapshot_file=snapshot_file)
+    job.run()
+    assert len(job.queries) == 1 and job.queries[0].startswith("insert into MYTABLE")
+    assert job.inserted_rows == 3
+
+    job = job_factory(SyncJob, "id", io.StringIO("id,name,lon,lat\n1,a,1,2\n2,x,1,2\n4,d,1,2\n"),
+                      columns="id,name", snapshot_file=snapshot_file)
+    job.run()
+    assert (job.inserted_rows, job.updated_rows, job.deleted_rows) == (1, 1, 1)
+    assert job.queries[0] == "update MYTABLE set  the_geom = st_transform(st_setsrid(st_makepoint(1.0, 2.0), 4326), 4326),name = 'x' where id = 2"
+    assert "'d'" in job.queries[1]
+    assert job.queries[2] == "delete from MYTABLE where id in (3.0)"
+
+def test_sync_job_repeated_ids(job_factory, tmp_path):
+    snapshot_file = str(tmp_path / "mytable.snapshot")
+    job = job_factory(SyncJob, "id", io.StringIO(DUPLICATED_CSV), columns="id,name", snapshot_file=snapshot_file)
+    job.run()
+    assert job.inserted_rows == 3 and job.skipped_rows == 2
+    assert "'a'" not in job.queries[0] and "'e'" in job.queries[0]
+
+    job = job_factory(SyncJob, "id", io.StringIO(DUPLICATED_CSV), columns="id,name", snapshot_file=snapshot_file,
+                      dedup=False)
+    with pytest.raises(ValueError):
+        job.run()
+
+def test_content_hash_mixes_bytes_and_unicode():
+    assert content_hash([b"caf\xc3\xa9", None]) == content_hash([u"caf\xe9", u""])
+
+def test_sync_job_keeps_snapshot_on_failure(job_factory, tmp_path):
+    snapshot_file = str(tmp_path / "mytable.snapshot")
+    job = job_factory(SyncJob, "id", io.StringIO("id,name\n1,a\n"), columns="id,name", snapshot_file=snapshot_file)
+    job.send = lambda query, file_encoding, chunk_num: job.failed_chunks.append(chunk_num + 1)
+    job.run()
+    assert not os.path.exists(snapshot_file)
+
+class FakeBatchSQLClient(object):
+    def __init__(self, statuses=None):
+        self.queries = []
+        self.statuses = statuses or {}
+
+    def create(self, query):
+        self.queries.append(query)
+        return {"job_id": str(len(self.queries))}
+
+    def read(self, job_id):
+        return {"job_id": job_id, "status": self.statuses.get(job_id, "done")}
+
+def test_staging_load(job_factory):
+    job = job_factory(InsertJob, io.StringIO("id,name,lon,lat\n1,a,1,2\n"), columns="id,name", staging=True, overviews=True)
+    job.bsql = FakeBatchSQLClient()
+    job.run()
+    assert job.queries[0] == "drop table if exists MYTABLE_etl_staging; " \
+        "create unlogged table MYTABLE_etl_staging (like MYTABLE including all excluding indexes); " \
+        "create sequence MYTABLE_etl_staging_cartodb_id_seq owned by MYTABLE_etl_staging.cartodb_id; " \
+        "alter table MYTABLE_etl_staging alter column cartodb_id set default nextval('MYTABLE_etl_staging_cartodb_id_seq')"
+    assert job.queries[1].startswith("insert into MYTABLE_etl_staging (the_geom,id,name) values")
+    assert len(job.bsql.queries) == 2
+    statements = [line.strip() for line in job.bsql.queries[0].splitlines()]
+    swap = [statements.index(statement) for statement in (
+        "alter table MYTABLE rename to MYTABLE_etl_old;",
+        "alter table MYTABLE_etl_staging rename to MYTABLE;",
+        "drop table MYTABLE_etl_old;",
+        "alter sequence MYTABLE_etl_staging_cartodb_id_seq rename to MYTABLE_cartodb_id_seq;")]
+    assert swap == sorted(swap)
+    assert "drop table MYTABLE;" not in statements
+    assert "information_schema.role_table_grants" in job.bsql.queries[0]
+    assert "pg_get_constraintdef(oid) as condef from pg_constraint" in job.bsql.queries[0]
+    assert "pg_get_triggerdef(oid) as tgdef from pg_trigger" in job.bsql.queries[0]
+    # Foreign keys and triggers are read before the live table is renamed
+    assert job.bsql.queries[0].index("from pg_trigger") < job.bsql.queries[0].index("rename to MYTABLE_etl_old")
+    assert "CDB_CreateOverviews" in job.bsql.queries[1]
+
+def test_staging_load_not_swapped_on_failure(job_factory):
+    job = job_factory(InsertJob, io.StringIO("id,name,lon,lat\n1,a,1,2\n"), columns="id,name", staging=True)
+    job.bsql = FakeBatchSQLClient()
+    job.send = lambda query, file_encoding, chunk_num: job.failed_chunks.append(chunk_num + 1)
+    job.run()
+    assert job.bsql.queries == []
+
+def test_staging_load_requires_whole_file(job_factory):
+    job = job_factory(InsertJob, io.StringIO("id,name,lon,lat\n1,a,1,2\n"), columns="id,name", staging=True)
+    job.bsql = FakeBatchSQLClient()
+    with pytest.raises(ValueError):
+        job.run(start_chunk=2)
+    assert job.queries == []
+
+@pytest.mark.parametrize("start_chunk,end_chunk,expected", [
+    (1, None, [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]),
+    (2, None, [[3, 4, 5], [6, 7, 8], [9]]),
+    (2, 2, [[3, 4, 5]]),
+    (4, 5, [[9]]),
+    (5, None, []),
+])
+def test_chunks(start_chunk, end_chunk, expected):
+    assert list(chunks(iter(range(10)), 3, start_chunk, end_chunk)) == expected
+
+def test_resume_chunks(job_factory):
+    job = job_factory(DeleteJob, "id", io.StringIO("id\n1\n2\n3\n4\n5\n"), chunk_size=2)
+    job.send_sql = lambda query, file_encoding, chunk_num: job.queries.append((chunk_num, query))
+    job.run(start_chunk=2, end_chunk=2)
+    assert job.queries == [(1, "delete from MYTABLE where id in (3.0,4.0)")]
+
+def test_batch_sql_dispatch(job_factory):
+    job = job_factory(DeleteJob, "id", io.StringIO("id\n1\n2\n3\n4\n5\n"), chunk_size=1,
+                      batch_sql=True, batch_group_size=2, batch_max_jobs=1, job_poll_interval=0)
+    job.bsql = FakeBatchSQLClient()
+    job.run()
+    assert job.queries == []
+    assert job.bsql.queries == [["delete from MYTABLE where id in (1.0)", "delete from MYTABLE where id in (2.0)"],
+                                ["delete from MYTABLE where id in (3.0)", "delete from MYTABLE where id in (4.0)"],
+                                "delete from MYTABLE where id in (5.0)"]
+    assert job.failed_chunks == []
+
+def test_batch_sql_failed_chunks():
+    bsql = FakeBatchSQLClient()
+    bsql.read = lambda job_id: {"job_id": job_id, "status": "failed",
+                                "query": [{"status": "done"}, {"status": "failed"}, {"status": "skipped"}]}
+    dispatcher = BatchDispatcher(bsql, max_jobs=2, group_size=3, max_attempts=1, poll_interval=0, max_poll_interval=0)
+    for chunk_num in range(3):
+        dispatcher.submit("select 1", chunk_num)
+    assert dispatcher.flush() == [2, 3]
+
+def test_batch_sql_unreadable_job_fails_its_chunks():
+    bsql = FakeBatchSQLClient()
+    reads = []
+    def read(job_id):
+        reads.append(job_id)
+        if job_id == "1":
+            raise Exception("404 Not Found")
+        return {"job_id": job_id, "status": "done"}
+    bsql.read = read
+    dispatcher = BatchDispatcher(bsql, max_jobs=2, group_size=1, max_attempts=3, poll_interval=0, max_poll_interval=0)
+    dispatcher.submit("select 1", 0)
+    dispatcher.submit("select 2", 1)
+    assert dispatcher.flush() == [1]
+    assert dispatcher.in_flight == {}
+    assert reads.count("1") == 3
+
+def test_batch_sql_resume_failed_chunks(job_factory):
+    job = job_factory(DeleteJob, "id", io.StringIO("id\n1\n2\n3\n4\n5\n"), chunk_size=1,
+                      batch_sql=True, batch_max_jobs=1, job_poll_interval=0)
+    job.bsql = FakeBatchSQLClient(statuses={"2": "failed", "4": "failed"})
+    job.run()
+    assert job.failed_chunks == [2, 4]
+
+    failed_chunks, job.failed_chunks = job.failed_chunks, []
+    job.bsql = FakeBatchSQLClient()
+    for chunk_num in failed_chunks:
+        job.csv_file_path.seek(0)
+        job.run(start_chunk=chunk_num, end_chunk=chunk_num)
+    assert job.bsql.queries == ["delete from MYTABLE where id in (2.0)", "delete from MYTABLE where id in (4.0)"]
+    assert job.failed_chunks == []
+
+class CountingRateLimiter(object):
+    def __init__(self):
+        self.requests = 0
+
+    def acquire(self):
+        self.requests += 1
+
+def test_batch_requests_are_rate_limited(job_factory):
+    job = job_factory(DeleteJob, "id", io.StringIO("id\n1\n2\n3\n"), chunk_size=1,
+                      batch_sql=True, batch_max_jobs=1, job_poll_interval=0)
+    job.bsql = FakeBatchSQLClient()
+    job.rate_limiter = CountingRateLimiter()
+    job.run()
+    # Three jobs created and polled once each
+    assert job.rate_limiter.requests == 6
+
+def test_staging_swap_is_rate_limited(job_factory):
+    job = job_factory(InsertJob, io.StringIO("id,name,lon,lat\n1,a,1,2\n"), columns="id,name", staging=True,
+                      overviews=True)
+    job.bsql = FakeBatchSQLClient()
+    job.rate_limiter = CountingRateLimiter()
+    job.run()
+    # Swap job created and polled, overviews job created
+    assert job.rate_limiter.requests == 3
+
+def test_insensitive_csv_reader():
+    reader = InsensitiveCSVReader(io.StringIO(" ID ,Name,LON\n1,a,3\n\n2\n"), columns=["Name"])
+    assert reader.fieldnames == ["id", "name", "lon"]
+    first, second = list(reader)
+    assert first["Name"] == "a" and first[" ID"] == "1" and first["lon"] == "3"
+    assert "name" in first and "missing" not in first
+    assert second["id"] == "2" and second["name"] is None
+    with pytest.raises(KeyError):
+        first["missing"]
+
+def test_insert_case_insensitive_columns(job_factory):
+    job = job_factory(InsertJob, io.StringIO("ID,NAME,LON,LAT\n1,a,1,2\n"), columns="id,name")
+    job.run()
+    assert job.queries == ["insert into MYTABLE (the_geom,id,name) values "
+                           "(st_transform(st_setsrid(st_makepoint(1.0, 2.0), 4326), 4326),1.0,'a')"]
+
+@pytest.mark.parametrize("opener", [open, gzip.open, bz2.open, lzma.open])
+def test_open_input_compressed(tmp_path, opener):
+    path = str(tmp_path / "input.csv")
+    with opener(path, "wb") as f:
+        f.write(u"id,name\n1,ñ\n".encode("utf-8"))
+    with open_input(path) as f:
+        assert f.read() == u"id,name\n1,ñ\n"
+
+@pytest.mark.parametrize("encoding", ["utf-8-sig", "utf-16", "utf-32"])
+def test_open_input_bom(tmp_path, encoding):
+    path = str(tmp_path / "input.csv")
+    with open(path, "wb") as f:
+        f.write(u"id,name\n1,ñ\n".encode(encoding))
+    with open_input(path, encoding="ISO-8859-1", use_mmap=False) as f:
+        assert f.read() == u"id,name\n1,ñ\n"
+
+def test_open_input_mmap(tmp_path):
+    path = str(tmp_path / "input.csv")
+    content = "".join("{row},name{row}\n".format(row=row) for row in range(5000))
+    with open(path, "w") as f:
+        f.write(content)
+    with open_input(path, buffer_size=4096, use_mmap=True) as f:
+        assert f.read() == content
+        f.seek(0)
+        assert f.readline() == "0,name0\n"
+
+def test_open_input_empty_file(tmp_path):
+    path = str(tmp_path / "input.csv")
+    open(path, "w").close()
+    with open_input(path) as f:
+        assert f.read() == u""
+
+def test_insert_from_compressed_file(job_factory, tmp_path):
+    path = str(tmp_path / "input.csv.gz")
+    with gzip.open(path, "wb") as f:
+        f.write(b"\xef\xbb\xbfid,name,lon,lat\n1,a,1,2\n")
+    job = job_factory(InsertJob, path, columns="id,name")
+    job.run()
+    assert job.queries == ["insert into MYTABLE (the_geom,id,name) values "
+                           "(st_transform(st_setsrid(st_makepoint(1.0, 2.0), 4326), 4326),1.0,'a')"]
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_total_rows_not_counted_for_compressed_file(job_factory, tmp_path, compressed):
+    path = str(tmp_path / "input.csv")
+    with (gzip.open if compressed else open)(path, "wb") as f:
+        f.write(b"id,name,lon,lat\n1,a,1,2\n")
+    messages = []
+    job = job_factory(InsertJob, path, columns="id,name", observer=messages.append)
+    job.run()
+    total_rows = [message for message in messages if message["type"] == "total_rows"]
+    assert len(total_rows) == (0 if compressed else 1)
+    assert len(job.queries) == 1
+
+def test_projected_csv_reader():
+    stream = io.StringIO(u'a,B,c,"D"\r\n1,2,3,4\r\n\r\n5,"x, ""y""\nz",7\n8\n')
+    reader = ProjectedCSVReader(stream, columns=["d", "b", "missing"])
+    assert reader.fieldnames == ["a", "b", "c", "d"]
+    first, second, third = list(reader)
+    assert first.values == ["4", "2"]
+    assert first["B"] == "2" and first["d"] == "4"
+    assert second["b"] == 'x, "y"\nz' and second["d"] is None
+    assert third["b"] is None
+    with pytest.raises(KeyError):
+        first["a"]
+
+def test_projected_csv_reader_matches_csv_reader():
+    with open(os.path.join(os.path.dirname(__file__), "..", "test_files", "sample_bbva.csv")) as f:
+        content = f.read()
+    columns = ["recId", "searchText", "country"]
+    projected = ProjectedCSVReader(io.StringIO(content), delimiter=";", columns=columns)
+    full = InsensitiveCSVReader(io.StringIO(content), delimiter=";", columns=columns)
+    for projected_record, record in zip(projected, full):
+        assert [projected_record[column] for column in columns] == [record[column] for column in columns]
+
+def test_pipeline_job(job_factory):
+    job = job_factory(DeleteJob, "id", io.StringIO("id\n1\n2\n3\n4\n5\n"), chunk_size=2,
+                      pipeline=True, pipeline_max_bytes=2, pipeline_queue_size=1)
+    job.run()
+    assert job.queries == ["delete from MYTABLE where id in (1.0,2.0)", "delete from MYTABLE where id in (3.0,4.0)",
+                           "delete from MYTABLE where id in (5.0)"]
+    assert [stats["stage"] for stats in job.pipeline_stats] == ["reader", "transformer", "sender"]
+    assert [stats["items"] for stats in job.pipeline_stats] == [3, 3, 3]
+
+def test_estimate_chunk_size_includes_overhead(job_factory):
+    job = job_factory(InsertJob, None, columns="id,name")
+    record_chunk = list(ProjectedCSVReader(io.StringIO("id,name\n1,a\n2,b\n"), columns=["id", "name"]))
+    characters = sum(len(value) for record in record_chunk for value in record.values)
+    assert job.estimate_chunk_size(record_chunk) > 20 * characters
+    assert job.estimate_chunk_size(record_chunk) > job.estimate_chunk_size(record_chunk[:1])
+
+def test_pipeline_error_removes_dedup_spill_directory(job_factory, tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    rows = "".join("{row},name\n".format(row=row % 50) for row in range(200))
+    job = job_factory(DeleteJob, "id", io.StringIO("id,name\n" + rows), chunk_size=10, pipeline=True,
+                      pipeline_queue_size=1, dedup="first", dedup_max_memory_ids=5)
+    def send(query, file_encoding, chunk_num):
+        raise RuntimeError("send failed")
+    job.send = send
+    with pytest.raises(RuntimeError):
+        job.run()
+    assert [name for name in os.listdir(str(tmp_path)) if name.startswith("carto-etl-")] == []
+
+def test_id_store_close_from_another_thread():
+    store = IdStore(max_memory_ids=1)
+    store.add("a")
+    store.add("b")
+    tmp_dir = store.tmp_dir
+    thread = threading.Thread(target=store.close)
+    thread.start()
+    thread.join()
+    assert not os.path.exists(tmp_dir)
+
+def test_pipeline_propagates_errors():
+    def transform(chunk):
+        raise ValueError(chunk)
+    pipeline = Pipeline(max_bytes=10, queue_size=1)
+    with pytest.raises(ValueError):
+        pipeline.run(enumerate(["a"] * 100), transform, lambda query, chunk_num: None)
+
+def test_bounded_queue_bytes():
+    queue = BoundedQueue(max_items=10, max_bytes=5)
+    queue.put("abc", 3)
+    producer = threading.Thread(target=queue.put, args=("def", 3))
+    producer.start()
+    producer.join(0.1)
+    assert producer.is_alive()
+    assert queue.get() == "abc"
+    producer.join(1)
+    assert not producer.is_alive()
+    queue.close()
+    with pytest.raises(PipelineClosed):
+        queue.put("ghi", 3)
+    assert queue.get() == "def"
+    with pytest.raises(PipelineClosed):
+        queue.get()
+
+@pytest.mark.parametrize("compression", [None, "gzip", "xz"])
+def test_directory_sink_and_replay(job_factory, tmp_path, compression):
+    directory = str(tmp_path / "sql")
+    job = DeleteJob("id", io.StringIO("id\n1\n2\n3\n"), table_name="MYTABLE", columns="", api_key="", chunk_size=2,
+                    sql_output_dir=directory, sql_output_compression=compression)
+    job.run()
+    assert job.failed_chunks == []
+    assert len(os.listdir(directory)) == 2
+
+    replay_job = job_factory(DeleteJob, "id", None)
+    replay_job.replay(directory, chunk_nums=[2])
+    assert replay_job.queries == ["delete from MYTABLE where id in (3.0)"]
+
+def test_directory_sink_removes_previous_export(job_factory, tmp_path):
+    directory = str(tmp_path / "sql")
+    DeleteJob("id", io.StringIO("id\n1\n2\n3\n"), table_name="MYTABLE", columns="", api_key="", chunk_size=1,
+              sql_output_dir=directory).run()
+    open(os.path.join(directory, "notes.txt"), "w").close()
+    DeleteJob("id", io.StringIO("id\n4\n"), table_name="MYTABLE", columns="", api_key="", chunk_size=1,
+              sql_output_dir=directory).run()
+    assert sorted(os.listdir(directory)) == ["chunk_000001.sql", "notes.txt"]
+
+    replay_job = job_factory(DeleteJob, "id", None)
+    replay_job.replay(directory)
+    assert replay_job.queries == ["delete from MYTABLE where id in (4.0)"]
+
+@pytest.mark.parametrize("api_key", ["", "1234"])
+def test_staging_rejected_with_sql_output_dir(tmp_path, api_key):
+    directory = str(tmp_path / "sql")
+    job = InsertJob(io.StringIO("id,name,lon,lat\n1,a,1,2\n"), table_name="MYTABLE", columns="id,name",
+                    api_key=api_key, base_url="http://wronguser123456.carto.com", staging=True,
+                    sql_output_dir=directory)
+    job.bsql = FakeBatchSQLClient()
+    with pytest.raises(ValueError):
+        job.run()
+    assert job.bsql.queries == []
+    assert os.listdir(directory) == []
+
+def test_sink_closed_after_run(job_factory):
+    job = job_factory(DeleteJob, "id", io.StringIO("id\n1\n"))
+    events = []
+    class RecordingSink(object):
+        def open(self, resume=False):
+            events.append(("open", resume))
+        def send(self, query, chunk_num):
+            events.append(("send", query))
+        def close(self):
+            events.append(("close",))
+    del job.send_sql
+    job.sink = RecordingSink()
+    job.run()
+    assert events == [("open", False), ("send", "delete from MYTABLE where id in (1.0)"), ("close",)]
+
+def test_delete_any_bigint(job_factory):
+    job = job_factory(DeleteJob, "id", io.StringIO("id\n1\n 2\n"), delete_strategy="any")
+    job.run()
+    assert job.queries == ["delete from MYTABLE where id = ANY(ARRAY[1,2]::bigint[])"]
+    assert job.id_type == "bigint"
+
+def test_delete_any_fails_chunk_with_invalid_ids(job_factory):
+    job = job_factory(DeleteJob, "id", io.StringIO("id\n1\n2.5\nabc\n4\n"), delete_strategy="any", chunk_size=2)
+    job.run()
+    assert job.queries == []
+    assert job.failed_chunks == [1, 2]
+
+class FakeSQLClient(object):
+    def __init__(self, column_type):
+        self.column_type = column_type
+        self.queries = []
+
+    def send(self, query):
+        self.queries.append(query)
+        return {"rows": [{"id_type": self.column_type}]}
+
+@pytest.mark.parametrize("column_type,ids", [("integer", "1,2"), ("text", "'1','2'"), ("uuid", "'1','2'")])
+def test_delete_any_reads_id_type_from_table(job_factory, column_type, ids):
+    job = job_factory(DeleteJob, "id", io.StringIO("id\n1\n2\n"), delete_strategy="any")
+    job.sql = FakeSQLClient(column_type)
+    job.run()
+    assert len(job.sql.queries) == 1 and "pg_attribute" in job.sql.queries[0]
+    id_type = "bigint" if column_type == "integer" else column_type
+    assert job.queries == ["delete from MYTABLE where id = ANY(ARRAY[{ids}]::{id_type}[])".format(ids=ids, id_type=id_type)]
+
+def test_delete_any_text(job_factory):
+    job = job_factory(DeleteJob, "id", io.StringIO("id\na'b\n2\n"), delete_strategy="any")
+    job.run()
+    assert job.queries == ["delete from MYTABLE where id = ANY(ARRAY['a''b','2']::text[])"]
+
+def test_delete_temp_table(job_factory):
+    job = job_factory(DeleteJob, "id", io.StringIO("id\n1.5\n2\n"), delete_strategy="temp_table")
+    job.run()
+    assert job.queries == ["begin; create temp table etl_delete_ids (id numeric) on commit drop; "
+                           "insert into etl_delete_ids (id) values (1.5),(2); "
+                           "delete from MYTABLE using etl_delete_ids where MYTABLE.id = etl_delete_ids.id; commit;"]
+
+def test_delete_any_numeric_keeps_digits(job_factory):
+    job = job_factory(DeleteJob, "id", io.StringIO("id\n12345678901234567.25\n-0.10000000000000000001\n"),
+                      delete_strategy="any", id_type="numeric")
+    job.run()
+    assert job.queries == ["delete from MYTABLE where id = "
+                           "ANY(ARRAY[12345678901234567.25,-0.10000000000000000001]::numeric[])"]
+
+def test_delete_any_numeric_rejects_non_finite_ids(job_factory):
+    job = job_factory(DeleteJob, "id", io.StringIO("id\n1.5\nNaN\n"), delete_strategy="any", id_type="numeric")
+    job.run()
+    assert job.queries == [] and job.failed_chunks == [1]
+
+def test_delete_explicit_id_type(job_factory):
+    job = job_factory(DeleteJob, "id", io.StringIO("id\n1\n"), delete_strategy="any", id_type="text")
+    job.run()
+    assert job.queries == ["delete from MYTABLE where id = ANY(ARRAY['1']::text[])"]
+
+def test_projected_coordinates_are_not_nulled(job_factory):
+    job = job_factory(InsertJob, None, columns="", srid=3857)
+    record = {"lon": "-412000.5", "lat": "4926000.25"}
+    assert job.get_longitude(record) == -412000.5
+    assert job.get_latitude(record) == 4926000.25
+    assert job.create_geom_query(record) == "st_transform(st_setsrid(st_makepoint(-412000.5, 4926000.25), 3857), 4326),"
+
+@pytest.mark.parametrize("profile_format", ["pstats", "collapsed"])
+def test_profile(job_factory, tmp_path, profile_format):
+    profile_file = str(tmp_path / "job.prof")
+    job = job_factory(DeleteJob, "id", io.StringIO("id\n1\n2\n3\n4\n5\n"), chunk_size=1,
+                      profile_file=profile_file, profile_format=profile_format, profile_chunks=2, profile_every=2)
+    job.run()
+    assert len(job.queries) == 5
+    assert os.path.exists(profile_file)
+    assert job.profiler.sampled_chunks == 2
+    assert job.profiler.chunk_index == 4
+    assert sorted(job.profiler.stages) == ["parse", "send", "serialize"]
+    assert all(stage.chunks == 2 for stage in job.profiler.stages.values())
+    if profile_format == "pstats":
+        assert pstats.Stats(profile_file).total_calls > 0
+    assert "Profiled 2 of 5 chunks" in job.profiler.summary()
+
+def test_profile_traces_memory_only_for_sampled_chunks(job_factory, tmp_path):
+    tracemalloc = pytest.importorskip("tracemalloc")
+    job = job_factory(DeleteJob, "id", io.StringIO("id\n1\n2\n3\n4\n"), chunk_size=1,
+                      profile_file=str(tmp_path / "job.prof"), profile_chunks=1, profile_every=2)
+    tracing = []
+    job.send_sql = lambda query, file_encoding, chunk_num: tracing.append(tracemalloc.is_tracing())
+    job.run()
+    assert tracing == [True, False, False, False]
+    assert not tracemalloc.is_tracing()
+    assert job.profiler.stages["send"].peak_memory > 0
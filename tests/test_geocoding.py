@@ -0,0 +1,18 @@
+from etl.geocoding import GeocodingContext, CartoGeocodingJob, get_default_context
+
+
+def test_context_settings_override_config():
+    context = GeocodingContext(config_file=None, max_attempts="5", output_columns="recId,city")
+    assert context.max_attempts == 5
+    assert context.output_columns == "recId,city"
+
+def test_context_sql_client_is_lazy_and_shared():
+    context = GeocodingContext(config_file=None, base_url="http://wronguser123456.carto.com", api_key="")
+    assert context._sql is None
+    assert context.sql is context.sql
+
+def test_jobs_share_default_context():
+    job1 = CartoGeocodingJob("test.csv")
+    job2 = CartoGeocodingJob("test.csv")
+    assert job1.context is job2.context is get_default_context()
+    assert job1.context._config is None
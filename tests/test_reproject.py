@@ -0,0 +1,52 @@
+import io
+import re
+
+import pytest
+
+pytest.importorskip("pyproj")
+
+from etl.etl import InsertJob, UpdateJob
+from etl.reproject import Reprojector
+
+POINT_REGEX = re.compile(r"st_makepoint\(([^,]+), ([^)]+)\)")
+
+
+def test_reprojector_3857():
+    longitude, latitude = Reprojector(3857).transform([111319.49079327357], [222684.20850554403])[0]
+    assert longitude == pytest.approx(1.0)
+    assert latitude == pytest.approx(2.0)
+
+def test_reprojector_rejects_non_finite_coordinates():
+    points = Reprojector(25830).transform([440000.0, None, float("nan"), 1e9], [4474000.0, 4474000.0, 4474000.0, 1e9])
+    assert points[0] is not None
+    assert points[1:] == [None, None, None]
+
+def test_reprojector_keeps_points_outside_area_of_use():
+    # Barcelona and Mallorca are outside the area of use of EPSG:25830
+    # (UTM zone 30N), but are routinely stored in it
+    reprojector = Reprojector(25830)
+    barcelona, mallorca = reprojector.transform([932306.0, 1015311.0], [4594967.0, 4400596.0])
+    assert barcelona == pytest.approx((2.17, 41.39), abs=1e-3)
+    assert mallorca == pytest.approx((3.0, 39.6), abs=1e-3)
+
+def test_reprojector_area_margin():
+    reprojector = Reprojector(25830, area_margin=0.5)
+    points = reprojector.transform([932306.0, 440000.0], [4594967.0, 1e9])
+    assert points[0] is not None
+    assert points[1] is None
+
+def test_insert_reprojected(job_factory):
+    job = job_factory(InsertJob, io.StringIO("id,lon,lat\n1,111319.49079327357,222684.20850554403\n2,1e12,0\n"),
+                      columns="id", srid=3857, reproject=True, reproject_area_margin=0)
+    job.run()
+    query = job.queries[0]
+    assert "st_transform" not in query
+    assert query.endswith(", 4326),1.0), (NULL,2.0)")
+    assert [float(coord) for coord in POINT_REGEX.search(query).groups()] == pytest.approx([1.0, 2.0])
+
+def test_update_reprojected(job_factory):
+    job = job_factory(UpdateJob, "id", io.StringIO("id,lon,lat\n1,111319.49079327357,222684.20850554403\n"),
+                      columns="id", srid=3857, reproject=True)
+    job.run()
+    assert job.queries[0].startswith("update MYTABLE set  the_geom = st_setsrid(st_makepoint(")
+    assert [float(coord) for coord in POINT_REGEX.search(job.queries[0]).groups()] == pytest.approx([1.0, 2.0])
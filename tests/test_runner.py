@@ -0,0 +1,86 @@
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+from etl.runner import JobRunner, RateLimiter, main
+
+CONFIG = """
+[carto]
+base_url=http://wronguser123456.carto.com
+api_key=
+delimiter=,
+columns=
+
+[etl]
+chunk_size=2
+max_attempts=1
+
+[runner]
+workers=2
+max_requests_per_second=0
+
+[job:first]
+table_name=first_table
+action=insert
+columns=id,name
+file={directory}/first.csv
+sql_output_dir={directory}/first_sql
+
+[job:second]
+action=delete
+id_column=id
+file={directory}/second.csv
+sql_output_dir={directory}/second_sql
+"""
+
+
+def write_config(tmp_path):
+    directory = str(tmp_path)
+    with open(os.path.join(directory, "first.csv"), "w") as f:
+        f.write("id,name,lon,lat\n1,a,1,2\n2,b,1,2\n3,c,1,2\n")
+    with open(os.path.join(directory, "second.csv"), "w") as f:
+        f.write("id\n1\n2\n")
+    config_file = os.path.join(directory, "etl.conf")
+    with open(config_file, "w") as f:
+        f.write(CONFIG.format(directory=directory))
+    return config_file
+
+def test_runner(tmp_path):
+    runner = JobRunner.from_file(write_config(tmp_path))
+    summaries = dict((summary["job"], summary) for summary in runner.run())
+    assert summaries["first"]["table"] == "first_table"
+    assert summaries["first"]["rows"] == 3
+    assert summaries["second"]["table"] == "second"
+    assert summaries["second"]["rows"] == 2
+    assert not summaries["first"]["error"] and not summaries["second"]["error"]
+    assert sorted(os.listdir(str(tmp_path / "first_sql"))) == ["chunk_000001.sql", "chunk_000002.sql"]
+    assert len(runner.accounts) == 1
+
+def test_runner_selected_jobs(tmp_path):
+    runner = JobRunner.from_file(write_config(tmp_path), job_names=["second"])
+    assert [summary["job"] for summary in runner.run()] == ["second"]
+
+def test_runner_main(tmp_path):
+    assert main([write_config(tmp_path), "--workers", "1"]) == 0
+
+def test_runner_shares_accounts_between_threads(tmp_path):
+    runner = JobRunner.from_file(write_config(tmp_path))
+    pool = ThreadPool(8)
+    try:
+        accounts = pool.map(lambda job: runner.get_account("http://user.carto.com", ""), range(64))
+    finally:
+        pool.close()
+        pool.join()
+    assert len(set(id(account) for account in accounts)) == 1
+
+def test_rate_limiter():
+    limiter = RateLimiter(50)
+    start = time.time()
+    for request in range(60):
+        limiter.acquire()
+    assert time.time() - start >= 0.15
+
+def test_runner_profile(tmp_path):
+    profile_dir = str(tmp_path / "profiles")
+    assert main([write_config(tmp_path), "--profile", profile_dir, "--profile-chunks", "1"]) == 0
+    assert sorted(os.listdir(profile_dir)) == ["first.prof", "second.prof"]